@@ -36,6 +36,12 @@ setup(name='zope.wfmc',
           + '\n\n' +
           read('src', 'zope', 'wfmc', 'xpdl.txt')
           + '\n\n' +
+          read('src', 'zope', 'wfmc', 'aio.txt')
+          + '\n\n' +
+          read('src', 'zope', 'wfmc', 'executor.txt')
+          + '\n\n' +
+          read('src', 'zope', 'wfmc', 'shard.txt')
+          + '\n\n' +
           read('CHANGES.txt')
           ),
       keywords = "zope3 wfmc xpdl workflow engine",
@@ -55,8 +61,13 @@ setup(name='zope.wfmc',
       package_dir = {'': 'src'},
       namespace_packages=['zope'],
       extras_require = dict(
-          test=['zope.testing'
-                ]),
+          test=['zope.testing',
+                'trollius',
+                'futures',
+                ],
+          asyncio=['trollius'],
+          futures=['futures'],
+          ),
       install_requires=['setuptools',
                         'zope.component',
                         'ZODB3',
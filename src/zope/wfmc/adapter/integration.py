@@ -16,30 +16,53 @@
 $Id$
 """
 
+import weakref
+
 from zope import component, interface
-from zope.wfmc import interfaces
+from zope.wfmc import interfaces, registry
 
 interface.moduleProvides(interfaces.IIntegration)
-    
-def createParticipant(activity, process_definition_identifier, performer):
-    participant = component.queryAdapter(
-        activity, interfaces.IParticipant,
-        process_definition_identifier + '.' + performer)
 
-    if participant is None:
-        participant = component.getAdapter(
-            activity, interfaces.IParticipant, '.' + performer)
+# Adapter registry -> (registry generation, factories), where the
+# factories found are kept by (object specification, provided
+# interface, process definition id, name).
+_factories = weakref.WeakKeyDictionary()
 
-    return participant
+def _adapt(object, provided, process_definition_identifier, name):
+    adapters = component.getSiteManager().adapters
+    cached = _factories.get(adapters)
+    generation = registry.adapterGeneration(
+        adapters, cached is not None and cached[0] or None)
+    if generation is None:
+        cached = None, {} # We can't tell when to forget factories.
+    elif cached is None or cached[0] is not generation:
+        cached = _factories[adapters] = generation, {}
 
-def createWorkItem(participant,
-                   process_definition_identifier, application):
+    spec = interface.providedBy(object)
+    key = spec, provided, process_definition_identifier, name
+    factories = cached[1].get(key)
+    if factories is None:
+        lookup = adapters.lookup
+        factories = cached[1][key] = [
+            factory for factory in (
+                lookup((spec, ), provided,
+                       process_definition_identifier + '.' + name),
+                lookup((spec, ), provided, '.' + name),
+                )
+            if factory is not None]
+
+    for factory in factories:
+        result = factory(object)
+        if result is not None:
+            return result
 
-    workitem = component.queryAdapter(
-        participant, interfaces.IWorkItem,
-        process_definition_identifier + '.' + application)
-    if workitem is None:
-        workitem = component.getAdapter(
-            participant, interfaces.IWorkItem, '.' + application)
+    raise component.ComponentLookupError(object, provided, '.' + name)
 
-    return workitem
+def createParticipant(activity, process_definition_identifier, performer):
+    return _adapt(activity, interfaces.IParticipant,
+                  process_definition_identifier, performer)
+
+def createWorkItem(participant,
+                   process_definition_identifier, application):
+    return _adapt(participant, interfaces.IWorkItem,
+                  process_definition_identifier, application)
@@ -0,0 +1,74 @@
+##############################################################################
+#
+# Copyright (c) 2004 Zope Corporation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Running work items in an asyncio event loop
+
+$Id$
+"""
+
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+
+from zope import interface
+from zope.wfmc import interfaces
+
+class AsyncExecutor(object):
+    """Executor for work items that return awaitables
+
+    Work items whose start methods return coroutines or futures are
+    run by the event loop.  When they are done, their results are
+    passed to the activities' ``workItemFinished`` methods.  Other
+    work items are expected to finish themselves, as usual.
+    """
+
+    interface.implements(interfaces.IWorkItemExecutor)
+
+    def __init__(self, loop=None):
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self.loop = loop
+        self.pending = set()
+
+    def execute(self, activity, workitem, arguments):
+        result = workitem.start(*arguments)
+        if not (asyncio.iscoroutine(result)
+                or isinstance(result, asyncio.Future)):
+            return
+
+        future = asyncio.ensure_future(result, loop=self.loop)
+        self.pending.add(future)
+
+        def done(future):
+            self.pending.discard(future)
+            if future.cancelled():
+                return
+            # Errors are left to the loop's exception handler and the
+            # work item stays unfinished.
+            results = future.result()
+            if results is None:
+                results = ()
+            activity.workItemFinished(workitem, *results)
+
+        future.add_done_callback(done)
+
+    def run(self):
+        """Run the loop until there are no more pending work items
+
+        Finishing work items can start new ones, which are waited for
+        too.
+        """
+        while self.pending:
+            self.loop.run_until_complete(asyncio.wait(list(self.pending),
+                                                      loop=self.loop))
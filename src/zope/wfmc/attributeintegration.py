@@ -37,3 +37,68 @@ class AttributeIntegration:
     def createWorkItem(self, participant,
                        process_definition_identifier, application):
         return getattr(self, application+'WorkItem')(participant)
+
+
+class TableIntegration(AttributeIntegration):
+    """Attribute integration that looks its factories up in advance
+
+    Process definitions are bound to the integration component with
+    ``bind``, which finds the participant and work-item factories the
+    definition needs, raising ``InvalidProcessDefinition`` if any are
+    missing.  Factories for bound definitions are then looked up in
+    tables, rather than by attribute name.  Definitions should be bound
+    again if they, or the factories, change.
+    """
+
+    def __init__(self):
+        self.participants = {}
+        self.workitems = {}
+
+    def bind(self, definition):
+        """Bind a process definition to the integration component
+        """
+        participants = {}
+        workitems = {}
+        missing = []
+        for id, activity in sorted(definition.activities.items()):
+            if not activity.applications:
+                continue # No participant is created
+            names = [(participants, activity.performer, 'Participant')]
+            for application, formal, actual in activity.applications:
+                names.append((workitems, application, 'WorkItem'))
+            for table, name, suffix in names:
+                if name in table:
+                    continue
+                factory = getattr(self, name + suffix, None)
+                if factory is None:
+                    missing.append(name + suffix)
+                table[name] = factory
+
+        if missing:
+            raise interfaces.InvalidProcessDefinition(
+                "Missing factories", definition.id, sorted(set(missing)))
+
+        self.participants[definition.id] = participants
+        self.workitems[definition.id] = workitems
+        definition.integration = self
+
+    def createParticipant(self, activity,
+                          process_definition_identifier, performer):
+        try:
+            factory = self.participants[process_definition_identifier][
+                performer]
+        except KeyError:
+            return AttributeIntegration.createParticipant(
+                self, activity, process_definition_identifier, performer)
+        return factory(activity)
+
+    def createWorkItem(self, participant,
+                       process_definition_identifier, application):
+        try:
+            factory = self.workitems[process_definition_identifier][
+                application]
+        except KeyError:
+            return AttributeIntegration.createWorkItem(
+                self, participant, process_definition_identifier,
+                application)
+        return factory(participant)
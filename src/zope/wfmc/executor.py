@@ -0,0 +1,92 @@
+##############################################################################
+#
+# Copyright (c) 2004 Zope Corporation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Running automatic work items in thread or process pools
+
+$Id$
+"""
+
+import Queue
+
+from zope import interface
+from zope.wfmc import interfaces, process
+
+def _start(workitem, arguments):
+    # Start a work item in the pool.  This is a module-level function,
+    # rather than the work item's bound method, so that process pools
+    # can pickle it.
+    return workitem.start(*arguments)
+
+class PoolExecutor(object):
+    """Executor that runs automatic work items in a pool
+
+    The pool is a ``concurrent.futures`` executor.  Only the start
+    methods of automatic work items are run in the pool.  Their results
+    are queued and passed to the work items' activities by the
+    ``finish`` and ``run`` methods, which must be called by the thread
+    that runs the processes.  Other work items are started directly.
+
+    For process pools, automatic work items and their arguments have to
+    be picklable.  The work items are started in the worker processes,
+    so changes they make to themselves aren't seen by the process.
+    """
+
+    interface.implements(interfaces.IWorkItemExecutor)
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.pending = 0
+        self.done = Queue.Queue()
+
+    def execute(self, activity, workitem, arguments):
+        if not interfaces.IAutomaticWorkItem.providedBy(workitem):
+            workitem.start(*arguments)
+            return
+
+        future = self.pool.submit(_start, workitem, arguments)
+        self.pending += 1
+        future.add_done_callback(
+            lambda future: self.done.put((activity, workitem, future)))
+
+    def finish(self, block=False, timeout=None):
+        """Finish the work items that are done
+
+        If block is true, wait for at least one work item, if any are
+        pending.  If a work item failed, the work items done before it
+        are finished and its error is raised.
+        """
+        finished = []
+        try:
+            while self.pending:
+                try:
+                    activity, workitem, future = self.done.get(
+                        block and not finished, timeout)
+                except Queue.Empty:
+                    break
+                self.pending -= 1
+                error = future.exception()
+                if error is not None:
+                    raise error
+                finished.append((activity, workitem, future.result() or ()))
+        finally:
+            if finished:
+                process.workItemsFinished(finished)
+
+    def run(self):
+        """Finish work items until none are pending
+
+        Finishing work items can start new ones, which are waited for
+        too.
+        """
+        while self.pending:
+            self.finish(True)
@@ -65,6 +65,23 @@ class IProcessDefinition(interface.Interface):
         """
         )
 
+    eventLevel = interface.Attribute(
+        """Events generated by process instances
+
+        One of the ``EVENTS_NONE``, ``EVENTS_LIFECYCLE`` and
+        ``EVENTS_FULL`` constants defined in ``zope.wfmc.process``.
+        """
+        )
+
+    executor = interface.Attribute(
+        """Work-item executor
+
+        An ``IWorkItemExecutor`` used to start the work items of
+        process instances, or None, in which case work items are
+        started directly.
+        """
+        )
+
     participants = interface.Attribute(
         """Process participants
 
@@ -101,6 +118,17 @@ class IProcessDefinition(interface.Interface):
         The transitions are ITransition objects.
         """
 
+    def build(activities=None, transitions=(), outgoing_refs=None):
+        """Define activities and transitions in bulk
+
+        Activities are given as a mapping from activity identifiers to
+        IActivityDefinition objects, and transitions as a sequence of
+        ITransition objects.  Outgoing references are given as a
+        mapping from activity identifiers to sequences of transition
+        identifiers defining the order of the activities' outgoing
+        transitions.
+        """
+
     def defineParticipants(**participants):
         """Declare participants
 
@@ -128,6 +156,21 @@ class IProcessDefinition(interface.Interface):
 
         """
 
+    def startMany(contexts, argument_rows=None):
+        """Create and start process instances for the given contexts
+
+        Argument rows, if given, provide the start arguments for each
+        process.  The started processes are returned.
+        """
+
+    def compile():
+        """Return an execution plan for the definition
+
+        The plan is a read-only, precomputed form of the definition
+        used by process instances.  It is recomputed when the
+        definition is changed.
+        """
+
 class IActivityDefinition(interface.Interface):
     """Activity definition
     """
@@ -231,6 +274,16 @@ class IActivity(interface.Interface):
 
     definition = interface.Attribute("Activity definition")
 
+    workitems = interface.Attribute(
+        """Unfinished work items
+
+        This is a mapping from work-item identifier to work item.
+        """)
+
+    def getWorkItem(work_item_id):
+        """Return the unfinished work item with the given identifier
+        """
+
     def workItemFinished(work_item, *results):
         """Notify the activity that the work item has been completed.
         """
@@ -283,6 +336,31 @@ class IWorkItem(interface.Interface):
         """Start the work
         """
 
+class IAutomaticWorkItem(IWorkItem):
+    """Work items that don't interact with their processes
+
+    Automatic work items are started by executors that support them,
+    such as ``zope.wfmc.executor.PoolExecutor``, which may run them in
+    other threads or processes.
+    """
+
+    def start(*arguments):
+        """Do the work and return a sequence of output values
+
+        Automatic work items don't call ``workItemFinished`` themselves.
+        """
+
+class IWorkItemExecutor(interface.Interface):
+    """Starts work items on behalf of activities
+    """
+
+    def execute(activity, workitem, arguments):
+        """Start the work item with the given input arguments
+
+        The activity's ``workItemFinished`` method must be called when
+        the work is done, either by the work item or by the executor.
+        This can happen before or after ``execute`` returns.
+        """
 
 class InvalidProcessDefinition(Exception):
     """A process definition isn't valid in some way.
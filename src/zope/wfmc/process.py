@@ -16,23 +16,237 @@
 $Id$
 """
 
+import cPickle
+import cStringIO
+import sys
+
 import persistent
+import persistent.mapping
+
+from BTrees.Length import Length
+from BTrees.OOBTree import OOBTree
 
 import zope.cachedescriptors.property
 
+from ZODB.ConflictResolution import PersistentReference
+from ZODB.POSException import ConflictError
+
 from zope import component, interface
 
 import zope.event
 
-from zope.wfmc import interfaces
+from zope.wfmc import interfaces, registry
+
+# Event levels
+EVENTS_NONE = 0      # Don't generate events
+EVENTS_LIFECYCLE = 1 # Process, activity and work-item events
+EVENTS_FULL = 2      # Lifecycle events and transitions
 
 def always_true(data):
     return True
 
-class TransitionDefinition(object):
+# The subscriber list seen by subscribed, its length and last
+# subscriber, and whether they listen.  Subscribers are normally added
+# and removed at the end of the list.
+_listening = [None, 0, None, False]
+
+# The adapter registry and generation for which _handled records
+# whether event classes have handlers.
+_handledRegistry = [None, None]
+_handled = {}
+
+def subscribed(factory):
+    """Return whether events created by the given class are handled
+
+    Subscribers in ``zope.event.subscribers`` are assumed to handle
+    all events, except for the subscriber used to track registrations
+    and the component-registry dispatcher, for which we check whether
+    there are handlers for the event class.
+    """
+    subscribers = zope.event.subscribers
+    cached = _listening
+    if (cached[0] is not subscribers
+        or cached[1] != len(subscribers)
+        or (subscribers and cached[2] is not subscribers[-1])):
+        dispatch = getattr(sys.modules.get('zope.component.event'),
+                           'dispatch', None)
+        listening = False
+        for subscriber in subscribers:
+            if subscriber is registry.registrationChanged:
+                continue
+            if subscriber is dispatch:
+                listening = dispatch
+                continue
+            listening = True
+            break
+        cached[:] = [subscribers, len(subscribers),
+                     subscribers and subscribers[-1] or None, listening]
+
+    listening = cached[3]
+    if listening is True:
+        return True
+    if not listening:
+        return False
+
+    # Whether there are handlers only changes when the adapter
+    # registries do.  If we can't tell, we look the handlers up every
+    # time.
+    adapters = component.getSiteManager().adapters
+    if _handledRegistry[0] is adapters:
+        generation = registry.adapterGeneration(
+            adapters, _handledRegistry[1])
+    else:
+        generation = registry.adapterGeneration(adapters)
+    if generation is None:
+        return bool(adapters.subscriptions(
+            (interface.implementedBy(factory), ), None))
+    if (_handledRegistry[0] is not adapters
+        or _handledRegistry[1] is not generation):
+        _handled.clear()
+        _handledRegistry[:] = [adapters, generation]
+    try:
+        return _handled[factory]
+    except KeyError:
+        handled = _handled[factory] = bool(adapters.subscriptions(
+            (interface.implementedBy(factory), ), None))
+        return handled
+
+def notify(level, factory, *args):
+    """Send an event, if the level allows it and anyone is listening
+
+    The event is only created if it's going to be sent.
+    """
+    if level >= factory.level and subscribed(factory):
+        zope.event.notify(factory(*args))
+
+def workItemsFinished(finished):
+    """Notify activities that many work items have been completed
+
+    The argument is a sequence of (activity, work item, results)
+    triples.  The work items are grouped by process.  For each process,
+    all of the results are written to the workflow-relevant data
+    before any of the activities that have no more work items are
+    finished, and each activity is only marked as changed once.
+    """
+    groups = []
+    by_process = {}
+    for activity, work_item, results in finished:
+        process = activity.process
+        group = by_process.get(id(process))
+        if group is None:
+            group = by_process[id(process)] = []
+            groups.append((process, group))
+        group.append((activity, work_item, tuple(results)))
+
+    for process, group in groups:
+        process._run(process._workItemsFinished(group))
+
+_missing = object()
+
+def _persistentId(object):
+    if isinstance(object, PersistentReference):
+        return object.database_name, object.oid
+    return None
+
+def _pickled(value):
+    f = cStringIO.StringIO()
+    pickler = cPickle.Pickler(f, 1)
+    pickler.persistent_id = _persistentId
+    pickler.dump(value)
+    return f.getvalue()
+
+def _same(a, b):
+    if a is b:
+        return True
+    if a is _missing or b is _missing:
+        return False
+    try:
+        if a == b:
+            return True
+    except ValueError:
+        pass # Persistent references can't always be compared
+
+    # Non-persistent objects in the states being merged, like
+    # transitions and work items, are loaded as separate copies, which
+    # usually don't define equality.  They're the same if their pickles
+    # are.
+    try:
+        return _pickled(a) == _pickled(b)
+    except (cPickle.PicklingError, TypeError):
+        return False
+
+def mergeState(old, committed, new, merge=None):
+    """Merge concurrent changes to a mapping, such as an object's state
+
+    Items changed on only one side are taken from that side.  Items
+    changed differently on both sides are merged by the function given
+    for the item name in merge, if any, which is called with the old,
+    committed and new values.  Otherwise, a ConflictError is raised.
+    """
+    result = {}
+    for name in set(old) | set(committed) | set(new):
+        o = old.get(name, _missing)
+        c = committed.get(name, _missing)
+        n = new.get(name, _missing)
+        if _same(c, n) or _same(o, n):
+            value = c
+        elif _same(o, c):
+            value = n
+        elif (merge is not None and name in merge and o is not _missing
+              and c is not _missing and n is not _missing):
+            value = merge[name](o, c, n)
+        else:
+            raise ConflictError
+        if value is not _missing:
+            result[name] = value
+    return result
+
+def _mergeBits(old, committed, new):
+    # Both sides may only have added bits
+    if old & ~committed or old & ~new:
+        raise ConflictError
+    return committed | new
+
+def _mergeRemoved(old, committed, new):
+    # Both sides may only have removed items, so we only need to
+    # compare keys.
+    if set(committed) - set(old) or set(new) - set(old):
+        raise ConflictError
+    return dict([(key, value) for (key, value) in committed.items()
+                 if key in new])
+
+class Slotted(object):
+    """Base class for classes with slots
+
+    Slots are pickled as a dictionary, like instance dictionaries, so
+    instances pickled before their classes had slots can be loaded.
+    The instance dictionaries of subclasses that don't define slots
+    are included.
+    """
+
+    __slots__ = ()
+
+    def __getstate__(self):
+        state = dict(getattr(self, '__dict__', ()))
+        for cls in self.__class__.__mro__:
+            for name in cls.__dict__.get('__slots__', ()):
+                try:
+                    state[name] = getattr(self, name)
+                except AttributeError:
+                    pass
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+class TransitionDefinition(Slotted):
 
     interface.implements(interfaces.ITransitionDefinition)
 
+    __slots__ = ('id', '__name__', 'description', 'from_', 'to',
+                 'condition')
+
     def __init__(self, from_, to, condition=always_true, id=None, __name__=None):
         self.id = id
         self.from_ = from_
@@ -51,6 +265,13 @@ class ProcessDefinition(object):
     
     TransitionDefinitionFactory = TransitionDefinition
 
+    # The events generated by process instances
+    eventLevel = EVENTS_FULL
+
+    # An IWorkItemExecutor used to start work items. If None, work
+    # items are started directly.
+    executor = None
+
     def __init__(self, id, integration=None):
         self.id = id
         self.integration = integration
@@ -65,23 +286,53 @@ class ProcessDefinition(object):
         return "ProcessDefinition(%r)" % self.id
 
     def defineActivities(self, **activities):
-        self._dirty()
-        for id, activity in activities.items():
-            activity.id = id
-            if activity.__name__ is None:
-                activity.__name__ = self.id + '.' + id
-            activity.process = self
-            self.activities[id] = activity
+        self.build(activities)
 
     def defineTransitions(self, *transitions):
+        self.build(transitions=transitions)
+
+    def build(self, activities=None, transitions=(), outgoing_refs=None):
+        """Define activities, transitions and outgoing transitions at once
+
+        Activities are given as a mapping from activity id to activity
+        definition and outgoing references as a mapping from activity
+        id to a sequence of transition ids, as would be passed to the
+        activities' addOutgoing methods.  The activities' transitions
+        are computed in a single pass, so this is the method to use
+        when building large definitions.
+        """
         self._dirty()
+
+        if activities:
+            for id, activity in activities.items():
+                activity.id = id
+                if activity.__name__ is None:
+                    activity.__name__ = self.id + '.' + id
+                activity.process = self
+                self.activities[id] = activity
+
+        transitions = tuple(transitions)
         self.transitions.extend(transitions)
 
         # Compute activity transitions based on transition data:
-        activities = self.activities
+        outgoing = {}
+        incoming = {}
         for transition in transitions:
-            activities[transition.from_].transitionOutgoing(transition)
-            activities[transition.to].incoming += (transition, )
+            outgoing.setdefault(transition.from_, []).append(transition)
+            incoming.setdefault(transition.to, []).append(transition)
+
+        activities = self.activities
+        for id, added in incoming.items():
+            activities[id].incoming += tuple(added)
+        for id, added in outgoing.items():
+            activities[id].transition_outgoing += tuple(added)
+        changed = set(outgoing)
+        if outgoing_refs:
+            for id, added in outgoing_refs.items():
+                activities[id].explicit_outgoing += tuple(added)
+            changed.update(outgoing_refs)
+        for id in changed:
+            activities[id].computeOutgoing()
 
     def defineApplications(self, **applications):
         for id, application in applications.items():
@@ -94,6 +345,7 @@ class ProcessDefinition(object):
             self.participants[id] = participant
 
     def defineParameters(self, *parameters):
+        self._dirty()
         self.parameters += parameters
 
     def _start(self):
@@ -125,24 +377,91 @@ class ProcessDefinition(object):
 
     _start = zope.cachedescriptors.property.Lazy(_start)
 
+    def compile(self):
+        """Return the execution plan for the definition
+
+        The plan is computed once and reused until the definition is
+        changed through its define methods or those of its activities.
+        """
+        return self._plan
+
+    def _plan(self):
+        return ExecutionPlan(self)
+
+    _plan = zope.cachedescriptors.property.Lazy(_plan)
+
     def __call__(self, context=None):
         return Process(self, self._start, context)
 
+    def startMany(self, contexts, argument_rows=None):
+        """Create and start a process instance for each of the contexts
+
+        If argument rows are given, there must be one for each context,
+        providing the arguments to the process's start method.  The
+        registered definition, the execution plan and the start
+        transition are looked up once for all of the processes.  If the
+        definition's integration component has a ``bind`` method, it's
+        called once, so the integration can look up the factories the
+        processes need in advance.  The processes are created by
+        calling the registered definition and are started by calling
+        their start methods.  The started processes are returned.
+        """
+        contexts = list(contexts)
+        if argument_rows is None:
+            argument_rows = [()] * len(contexts)
+        else:
+            argument_rows = list(argument_rows)
+            if len(argument_rows) != len(contexts):
+                raise TypeError("Expected %s argument rows. got %s" %
+                                (len(contexts), len(argument_rows)))
+
+        definition = component.getUtility(
+            interfaces.IProcessDefinition, self.id)
+        key = component.getSiteManager(), registry.generation()
+        definition.compile()
+
+        # Missing factories are reported when they're needed, as they
+        # are when processes are started one at a time.
+        bind = getattr(definition.integration, 'bind', None)
+        if bind is not None:
+            try:
+                bind(definition)
+            except interfaces.InvalidProcessDefinition:
+                pass
+
+        processes = []
+        for context, arguments in zip(contexts, argument_rows):
+            process = definition(context)
+            process._v_definition = key, definition
+            process.start(*arguments)
+            processes.append(process)
+        return processes
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_plan', None)
+        return state
+
     def _dirty(self):
-        try:
-            del self._start
-        except AttributeError:
-            pass
+        for name in ('_start', '_plan'):
+            try:
+                delattr(self, name)
+            except AttributeError:
+                pass
 
-class ActivityDefinition(object):
+class ActivityDefinition(Slotted):
 
     interface.implements(interfaces.IActivityDefinition)
 
-    performer = ''
-    process = None
+    __slots__ = ('id', '__name__', 'description', 'process', 'performer',
+                 'incoming', 'outgoing', 'transition_outgoing',
+                 'explicit_outgoing', 'applications', 'andJoinSetting',
+                 'andSplitSetting')
 
     def __init__(self, __name__=None):
         self.__name__ = __name__
+        self.process = None
+        self.performer = ''
         self.incoming = self.outgoing = ()
         self.transition_outgoing = self.explicit_outgoing = ()
         self.applications = ()
@@ -150,9 +469,11 @@ class ActivityDefinition(object):
         self.description = None
 
     def andSplit(self, setting):
+        self._dirty()
         self.andSplitSetting = setting
 
     def andJoin(self, setting):
+        self._dirty()
         self.andJoinSetting = setting
 
     def addApplication(self, application, actual=()):
@@ -162,34 +483,198 @@ class ActivityDefinition(object):
             raise TypeError("Wrong number of parameters => "
                             "Actual=%s, Formal=%s for Application %s with id=%s"
                             %(actual, formal, app, app.id))
+        self._dirty()
         self.applications += ((application, formal, tuple(actual)), )
 
     def definePerformer(self, performer):
+        self._dirty()
         self.performer = performer
 
     def addOutgoing(self, transition_id):
+        self._dirty()
         self.explicit_outgoing += (transition_id,)
         self.computeOutgoing()
 
     def transitionOutgoing(self, transition):
+        self._dirty()
         self.transition_outgoing += (transition,)
         self.computeOutgoing()
 
     def computeOutgoing(self):
         if self.explicit_outgoing:
             transitions = dict([(t.id, t) for t in self.transition_outgoing])
-            self.outgoing = ()
-            for tid in self.explicit_outgoing:
-                transition = transitions.get(tid)
-                if transition is not None:
-                    self.outgoing += (transition,)
+            self.outgoing = tuple([transitions[tid]
+                                   for tid in self.explicit_outgoing
+                                   if tid in transitions])
         else:
             self.outgoing = self.transition_outgoing
 
+    def _dirty(self):
+        if self.process is not None:
+            self.process._dirty()
+
+    def __setstate__(self, state):
+        # Older versions had class defaults for the process and
+        # performer.
+        Slotted.__setstate__(self, dict(process=None, performer=''))
+        Slotted.__setstate__(self, state)
+
     def __repr__(self):
         return "<ActivityDefinition %r>" %self.__name__
 
 
+class ExecutionPlan(object):
+    """Compiled, read-only form of a process definition
+
+    Activities are numbered.  Each compiled activity knows the indexes
+    of the activities its outgoing transitions lead to, so that
+    process instances can run without looking up activity
+    definitions by id.
+    """
+
+    def __init__(self, definition):
+        self.definition = definition
+
+        ids = sorted(definition.activities)
+        self.index = dict([(id, i) for (i, id) in enumerate(ids)])
+        self.activities = tuple([
+            CompiledActivity(self, i, definition.activities[id])
+            for (i, id) in enumerate(ids)
+            ])
+
+        self.inputs = tuple([parameter.__name__
+                             for parameter in definition.parameters
+                             if parameter.input])
+        self.outputs = tuple([parameter.__name__
+                              for parameter in definition.parameters
+                              if parameter.output])
+
+    def __getitem__(self, activity_definition_identifier):
+        return self.activities[self.index[activity_definition_identifier]]
+
+    def __repr__(self):
+        return "ExecutionPlan(%r)" % self.definition.id
+
+
+class CompiledActivity(object):
+    """Compiled form of an activity definition
+    """
+
+    def __init__(self, plan, index, definition):
+        self.plan = plan
+        self.index = index
+        self.id = definition.id
+        self.definition = definition
+        self.performer = definition.performer
+        self.andSplit = bool(definition.andSplitSetting)
+        # A join without incoming transitions, like the start
+        # activity, has nothing to wait for.
+        self.andJoin = bool(definition.andJoinSetting
+                            and definition.incoming)
+        self.joinBits = dict([(transition, 1 << i)
+                              for (i, transition)
+                              in enumerate(definition.incoming)])
+        self.joinMask = (1 << len(definition.incoming)) - 1
+        self.outgoing = tuple([(transition, plan.index[transition.to])
+                               for transition in definition.outgoing])
+        if self.andSplit:
+            self.choices = ()
+        else:
+            self.choices = _choices(self.outgoing)
+
+        applications = []
+        for application, formal, actual in definition.applications:
+            inputs = tuple([name for (parameter, name) in zip(formal, actual)
+                            if parameter.input])
+            outputs = tuple([name for (parameter, name) in zip(formal, actual)
+                             if parameter.output])
+            applications.append(
+                (application, formal, actual, inputs, outputs))
+        self.applications = tuple(applications)
+
+    def choose(self, data):
+        """Return the first outgoing transition with a true condition
+
+        The transition is returned with the index of the activity it
+        leads to.  None is returned if no condition is true.
+        """
+        for name, table, run in self.choices:
+            if name is not None:
+                try:
+                    choice = table.get(data[name])
+                except (KeyError, TypeError):
+                    pass # Let the conditions decide
+                else:
+                    if choice is not None:
+                        return choice
+                    continue
+
+            for transition, index in run:
+                if transition.condition(data):
+                    return transition, index
+
+        return None
+
+    def __repr__(self):
+        return "CompiledActivity(%r)" % self.id
+
+def _guard(transition):
+    guard = getattr(transition.condition, 'guard', None)
+    if guard is not None:
+        try:
+            hash(guard)
+        except TypeError:
+            return None
+    return guard
+
+def _choices(outgoing):
+    # Group the outgoing transitions of an xor split into
+    # (variable name, table, transitions) choices.  Consecutive
+    # transitions whose conditions compare the same variable with
+    # constants are chosen by looking the variable's value up in a
+    # table of the first transitions for the constants.  Other
+    # transitions are tested in order, and have no name or table.
+    choices = []
+    run = []
+    name = None
+    for transition, index in outgoing + ((None, None), ):
+        guard = transition is not None and _guard(transition) or None
+        if run and (guard is None or guard[0] != name):
+            if name is not None and len(run) > 1:
+                table = {}
+                for t, i in run:
+                    table.setdefault(_guard(t)[1], (t, i))
+                choices.append((name, table, tuple(run)))
+            elif choices and choices[-1][0] is None:
+                choices[-1] = None, None, choices[-1][2] + tuple(run)
+            else:
+                choices.append((None, None, tuple(run)))
+            run = []
+        if transition is not None:
+            run.append((transition, index))
+            name = guard and guard[0]
+    return tuple(choices)
+
+
+class Activities(persistent.mapping.PersistentMapping):
+    """The running activities of a process, by id
+
+    Activities finished and started in separate transactions can be
+    merged, unless, together, they finish the last activities, so that
+    neither transaction finished the process.  (A BTree can't merge
+    concurrent deletes of its first key, which, since activity ids only
+    grow, is the oldest running activity.)
+    """
+
+    def _p_resolveConflict(self, old, committed, new):
+        return mergeState(old, committed, new, dict(data=_mergeActivities))
+
+def _mergeActivities(old, committed, new):
+    activities = mergeState(old, committed, new)
+    if not activities and committed and new:
+        raise ConflictError
+    return activities
+
 class Process(persistent.Persistent):
 
     interface.implements(interfaces.IProcess)
@@ -198,103 +683,388 @@ class Process(persistent.Persistent):
         self.process_definition_identifier = definition.id
         self.startTransition = start
         self.context = context
-        self.activities = {}
-        self.nextActivityId = 0
+        # Activities, waiting joins and the activity-id counter are
+        # stored in separate persistent objects, so that transitions
+        # don't rewrite the process record.
+        self.activities = Activities()
+        self.joins = OOBTree()
+        self.activityIds = Length()
         self.workflowRelevantData = WorkflowData()
         self.applicationRelevantData = WorkflowData()
 
     def definition(self):
-        return component.getUtility(
+        # The definition is cached in a volatile attribute, for the
+        # current site manager and registration generation.
+        key = component.getSiteManager(), registry.generation()
+        cached = getattr(self, '_v_definition', None)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        definition = component.getUtility(
             interfaces.IProcessDefinition,
             self.process_definition_identifier,
             )
+        self._v_definition = key, definition
+        return definition
     definition = property(definition)
 
+    # Processes created by older versions keep their activities and
+    # joins in dictionaries and count activity ids in nextActivityId.
+    # They're converted when they next make a transition.
+    activityIds = None
+
+    def nextActivityId(self):
+        if self.activityIds is None:
+            return self.__dict__['nextActivityId']
+        return self.activityIds()
+    nextActivityId = property(nextActivityId)
+
+    def _p_resolveConflict(self, old, committed, new):
+        return mergeState(old, committed, new)
+
+    def _convert(self):
+        state = self.__dict__
+        self.activities = Activities(self.activities)
+        self.joins = OOBTree()
+        self.activityIds = Length(state.pop('nextActivityId', 0))
+
+        # Older and-join activities record the transitions that have
+        # arrived in an incoming tuple, and are found by searching the
+        # process's activities.  We record the transitions as bits and
+        # index the joins that are still waiting.
+        plan = self.definition.compile()
+        for activity in self.activities.values():
+            incoming = activity.__dict__.get('incoming')
+            if incoming is None:
+                continue
+            del activity.incoming
+            try:
+                node = plan[activity.activity_definition_identifier]
+            except KeyError:
+                continue # The definition has changed; leave it alone.
+            if not node.andJoin:
+                continue
+
+            # The incoming transitions are copies of the definition's,
+            # so they're matched by their ids and activities.
+            bits = dict([((t.id, t.from_, t.to), bit)
+                         for (t, bit) in node.joinBits.items()])
+            for transition in incoming:
+                activity.arrived |= bits.get(
+                    (transition.id, transition.from_, transition.to), 0)
+            activity.joinMask = node.joinMask
+            if activity.arrived != node.joinMask:
+                self.joins[node.id] = activity
+
     def start(self, *arguments):
+        definition = self.definition
+        self._start(definition, definition.compile(), arguments)
+
+    def _start(self, definition, plan, arguments):
         if self.activities:
             raise TypeError("Already started")
 
-        definition = self.definition
         data = self.workflowRelevantData
         args = arguments
-        for parameter in definition.parameters:
-            if parameter.input:
-                arg, args = args[0], args[1:]
-                setattr(data, parameter.__name__, arg)
+        for name in plan.inputs:
+            arg, args = args[0], args[1:]
+            setattr(data, name, arg)
         if args:
             raise TypeError("Too many arguments. Expected %s. got %s" %
                             (len(definition.parameters), len(arguments)))
 
-        zope.event.notify(ProcessStarted(self))
-        self.transition(None, (self.startTransition, ))
+        notify(definition.eventLevel, ProcessStarted, self)
+        start = self.startTransition
+        self._run(self._transition(None, ((start, plan[start.to]), )))
 
     def outputs(self):
-        outputs = []
-        for parameter in self.definition.parameters:
-            if parameter.output:
-                outputs.append(
-                    getattr(self.workflowRelevantData,
-                            parameter.__name__))
-
-        return outputs
+        data = self.workflowRelevantData
+        return [getattr(data, name)
+                for name in self.definition.compile().outputs]
 
     def _finish(self):
         if self.context is not None:
             self.context.processFinished(self, *self.outputs())
 
-        zope.event.notify(ProcessFinished(self))
+        notify(self.definition.eventLevel, ProcessFinished, self)
 
 
     def transition(self, activity, transitions):
-        if transitions:
-            definition = self.definition
-
-            for transition in transitions:
-                activity_definition = definition.activities[transition.to]
-                next = None
-                if activity_definition.andJoinSetting:
-                    # If it's an and-join, we want only one.
-                    for i, a in self.activities.items():
-                        if a.activity_definition_identifier == transition.to:
-                            # we already have the activity -- use it
-                            next = a
-                            break
-
-                if next is None:
-                    next = Activity(self, activity_definition)
-                    self.nextActivityId += 1
-                    next.id = self.nextActivityId
-
-                zope.event.notify(Transition(activity, next))
-                self.activities[next.id] = next
-                next.start(transition)
+        plan = self.definition.compile()
+        self._run(self._transition(activity,
+                                   [(transition, plan[transition.to])
+                                    for transition in transitions],
+                                   ))
+
+    # How deeply steps run while running steps may nest before they're
+    # left to the outermost loop.
+    maxNesting = 50
+
+    def _run(self, step):
+        # Execute a step without recursion.
+        #
+        # Steps are generators that yield the steps that have to be
+        # executed before they can continue, or None.  They're kept on
+        # a stack, so they're executed in the same order as if they
+        # called each other.  A step run while we're already running
+        # steps, as when a work item finishes as soon as it's started,
+        # is run to completion before we return, as it was when
+        # activities called each other.  In long chains of such work
+        # items, like those of automatic activities, that would nest
+        # without limit, so beyond maxNesting levels, steps are pushed
+        # on the outermost stack, to be run when the step that's
+        # running yields or returns.
+        running = getattr(self, '_v_running', None)
+        if running is None:
+            running = self._v_running = [0, None]
+        elif running[0] >= self.maxNesting:
+            running[1].append(step)
+            return
+
+        steps = [step]
+        if running[1] is None:
+            running[1] = steps
+        running[0] += 1
+        try:
+            while steps:
+                i = len(steps) - 1
+                try:
+                    step = steps[i].next()
+                except StopIteration:
+                    del steps[i]
+                else:
+                    if step is not None:
+                        steps.append(step)
+        finally:
+            running[0] -= 1
+            if not running[0]:
+                del self._v_running
+
+    def _workItemsFinished(self, finished):
+        definition = self.definition
+        plan = definition.compile()
+
+        # Check everything before changing anything:
+        seen = set()
+        for activity, work_item, results in finished:
+            key = id(activity), work_item.id
+            if key in seen or work_item.id not in activity.workitems:
+                raise interfaces.ProcessError(
+                    "Unknown or repeated work item %r for %r"
+                    % (work_item, activity))
+            seen.add(key)
+            node = plan[activity.activity_definition_identifier]
+            outputs = node.applications[work_item.id - 1][4]
+            if len(results) > len(outputs):
+                raise TypeError("Too many results")
+            if len(results) < len(outputs):
+                raise TypeError("Too few results")
+
+        values = {}
+        changed = {}
+        activities = []
+        events = []
+        for activity, work_item, results in finished:
+            node = plan[activity.activity_definition_identifier]
+            del activity.workitems[work_item.id]
+            if id(activity) not in changed:
+                changed[id(activity)] = node
+                activities.append(activity)
+            app, formal, actual, inputs, outputs = node.applications[
+                work_item.id - 1]
+            values.update(zip(outputs, results))
+            events.append((work_item, app, actual, results))
+
+        data = self.workflowRelevantData
+        for name, value in values.items():
+            setattr(data, name, value)
+        for activity in activities:
+            activity._p_changed = True
+
+        for args in events:
+            notify(definition.eventLevel, WorkItemFinished, *args)
+
+        for activity in activities:
+            if not activity.workitems:
+                yield activity._finish(changed[id(activity)])
+
+    def _transition(self, activity, steps):
+        # Follow compiled transitions; steps are (transition, compiled
+        # target activity) pairs.
+        if self.activityIds is None:
+            self._convert()
+
+        level = self.definition.eventLevel
+        activityIds = self.activityIds
+        for transition, node in steps:
+            next = None
+            if node.andJoin:
+                # If it's an and-join, we want only one, so use the
+                # one that's waiting for transitions, if there is one.
+                next = self.joins.get(node.id)
+
+            if next is None:
+                next = Activity(self, node.definition)
+                activityIds.change(1)
+                next.id = activityIds()
+                if node.andJoin:
+                    next.joinMask = node.joinMask
+                    self.joins[node.id] = next
+
+            notify(level, Transition, activity, next)
+            self.activities[next.id] = next
+            yield next._start(transition, node)
 
         if activity is not None:
             del self.activities[activity.id]
             if not self.activities:
                 self._finish()
 
-        self._p_changed = True
-
     def __repr__(self):
         return "Process(%r)" % self.process_definition_identifier
 
+class Variable(persistent.Persistent):
+    """Large workflow variable value, stored in a record of its own
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+# Values of these types are always small
+_scalars = bool, int, long, float, complex, type(None)
+
+def _storedId(object):
+    if isinstance(object, persistent.Persistent):
+        return 1
+    return None
+
+def _storedSize(value):
+    # The size of a value's pickle, not counting the persistent objects
+    # it refers to, which are stored in records of their own.
+    f = cStringIO.StringIO()
+    pickler = cPickle.Pickler(f, 1)
+    pickler.persistent_id = _storedId
+    pickler.dump(value)
+    return f.tell()
+
+def _isPrivate(name):
+    return name.startswith('_p_') or name.startswith('_v_') or (
+        name.startswith('__') or name == '_variables')
+
 class WorkflowData(persistent.Persistent):
     """Container for workflow-relevant and application-relevant data
+
+    Variables are accessed as attributes or items.  They're kept in a
+    BTree, so that changing a variable doesn't rewrite the others and
+    concurrent changes to different variables can be merged.  Values
+    that take more than inlineLimit bytes, like long strings or large
+    documents, are kept in records of their own.
     """
 
-class ProcessStarted:
+    inlineLimit = 1024
+
+    # Data stored by older versions keep variables in their instance
+    # dictionaries.  They're converted when a variable is next set.
+    _variables = None
+
+    def __init__(self):
+        self._variables = OOBTree()
+
+    def __getitem__(self, name):
+        variables = self._variables
+        if variables is None:
+            return self.__dict__[name]
+        value = variables[name]
+        if isinstance(value, Variable):
+            value = value.value
+        return value
+
+    def __iter__(self):
+        variables = self._variables
+        if variables is None:
+            return iter([name for name in self.__dict__
+                         if not _isPrivate(name)])
+        return iter(variables)
+
+    def __getattr__(self, name):
+        if not _isPrivate(name):
+            try:
+                return self[name]
+            except KeyError:
+                pass
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        if _isPrivate(name):
+            persistent.Persistent.__setattr__(self, name, value)
+            return
+
+        variables = self._variables
+        if variables is None:
+            variables = self._convert()
+
+        if self._isLarge(value):
+            old = variables.get(name)
+            if isinstance(old, Variable):
+                old.value = value
+                return
+            value = Variable(value)
+        variables[name] = value
+
+    def _isLarge(self, value):
+        if isinstance(value, basestring):
+            return len(value) > self.inlineLimit
+        if type(value) in _scalars or isinstance(value, persistent.Persistent):
+            return False
+        try:
+            return _storedSize(value) > self.inlineLimit
+        except Exception:
+            return False # It can't be stored anyway
+
+    def __delattr__(self, name):
+        if _isPrivate(name):
+            persistent.Persistent.__delattr__(self, name)
+            return
+
+        variables = self._variables
+        if variables is None:
+            variables = self._convert()
+        try:
+            del variables[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def _convert(self):
+        state = self.__dict__
+        names = [name for name in state if not _isPrivate(name)]
+        self._variables = OOBTree()
+        for name in names:
+            setattr(self, name, state.pop(name))
+        return self._variables
+
+    def _p_resolveConflict(self, old, committed, new):
+        return mergeState(old, committed, new)
+
+class ProcessStarted(object):
     interface.implements(interfaces.IProcessStarted)
 
+    __slots__ = ('process', )
+
+    level = EVENTS_LIFECYCLE
+
     def __init__(self, process):
         self.process = process
 
     def __repr__(self):
         return "ProcessStarted(%r)" % self.process
 
-class ProcessFinished:
+class ProcessFinished(object):
     interface.implements(interfaces.IProcessFinished)
 
+    __slots__ = ('process', )
+
+    level = EVENTS_LIFECYCLE
+
     def __init__(self, process):
         self.process = process
 
@@ -330,78 +1100,147 @@ class Activity(persistent.Persistent):
                     )
                 i += 1
                 workitem.id = i
-                workitems[i] = workitem, application, formal, actual
+                # The application and parameters are found in the
+                # definition's applications by work item id.
+                workitems[i] = workitem
 
         self.workitems = workitems
 
     def definition(self):
-        return self.process.definition.activities[
-            self.activity_definition_identifier]
+        return self._node().definition
     definition = property(definition)
 
-    incoming = ()
+    def _node(self):
+        return self.process.definition.compile()[
+            self.activity_definition_identifier]
+
+    # Bit set of the incoming transitions of an and-join that have
+    # occurred, with bits assigned by the compiled activity.
+    arrived = 0
+
+    # The bit set of all of the incoming transitions of an and-join,
+    # used to resolve conflicts.
+    joinMask = 0
+
+    def getWorkItem(self, work_item_id):
+        """Return the unfinished work item with the given id
+        """
+        workitem = self.workitems[work_item_id]
+        if type(workitem) is tuple:
+            # Activities stored by older versions keep (work item,
+            # application, formal parameters, actual parameters) tuples.
+            workitem = workitem[0]
+        return workitem
+
     def start(self, transition):
-        # Start the activity, if we've had enough incoming transitions
+        self.process._run(self._start(transition, self._node()))
 
-        definition = self.definition
+    def _start(self, transition, node):
+        # Start the activity, if we've had enough incoming transitions
 
-        if definition.andJoinSetting:
-            if transition in self.incoming:
+        if node.andJoin:
+            bit = node.joinBits[transition]
+            if self.arrived & bit:
                 raise interfaces.ProcessError(
                     "Repeated incoming %s with id='%s' "
                     "while waiting for and completion"
                     %(transition, transition.id))
-            self.incoming += (transition, )
+            self.arrived |= bit
 
-            if len(self.incoming) < len(definition.incoming):
+            if self.arrived != node.joinMask:
                 return # not enough incoming yet
 
-        zope.event.notify(ActivityStarted(self))
+            # We're no longer waiting
+            joins = self.process.joins
+            if joins.get(node.id) is self:
+                del joins[node.id]
+
+        notify(node.plan.definition.eventLevel, ActivityStarted, self)
 
         if self.workitems:
-            for workitem, app, formal, actual in self.workitems.values():
-                args = []
-                for parameter, name in zip(formal, actual):
-                    if parameter.input:
-                        args.append(
-                            getattr(self.process.workflowRelevantData, name))
-                workitem.start(*args)
+            data = self.process.workflowRelevantData
+            applications = node.applications
+            executor = node.plan.definition.executor
+            for i in self.workitems.keys():
+                workitem = self.getWorkItem(i)
+                args = [getattr(data, name) for name in applications[i - 1][3]]
+                if executor is None:
+                    workitem.start(*args)
+                else:
+                    executor.execute(self, workitem, args)
         else:
             # Since we don't have any work items, we're done
-            self.finish()
+            yield self._finish(node)
 
     def workItemFinished(self, work_item, *results):
-        unused, app, formal, actual = self.workitems.pop(work_item.id)
+        node = self._node()
+        del self.workitems[work_item.id]
         self._p_changed = True
+        app, formal, actual, inputs, outputs = node.applications[
+            work_item.id - 1]
+        data = self.process.workflowRelevantData
         res = results
-        for parameter, name in zip(formal, actual):
-            if parameter.output:
-                v = res[0]
-                res = res[1:]
-                setattr(self.process.workflowRelevantData, name, v)
+        for name in outputs:
+            v, res = res[0], res[1:]
+            setattr(data, name, v)
 
         if res:
             raise TypeError("Too many results")
 
-        zope.event.notify(WorkItemFinished(
-            work_item, app, actual, results))
+        notify(node.plan.definition.eventLevel, WorkItemFinished,
+               work_item, app, actual, results)
 
         if not self.workitems:
-            self.finish()
+            self.process._run(self._finish(node))
 
     def finish(self):
-        zope.event.notify(ActivityFinished(self))
-
-        definition = self.definition
-
-        transitions = []
-        for transition in definition.outgoing:
-            if transition.condition(self.process.workflowRelevantData):
-                transitions.append(transition)
-                if not definition.andSplitSetting:
-                    break # xor split, want first one
-
-        self.process.transition(self, transitions)
+        self.process._run(self._finish(self._node()))
+
+    def _finish(self, node):
+        notify(node.plan.definition.eventLevel, ActivityFinished, self)
+
+        process = self.process
+        plan = node.plan
+        data = process.workflowRelevantData
+        steps = []
+        if node.andSplit:
+            for transition, index in node.outgoing:
+                if transition.condition(data):
+                    steps.append((transition, plan.activities[index]))
+        else:
+            # xor split, want first one
+            choice = node.choose(data)
+            if choice is not None:
+                transition, index = choice
+                steps.append((transition, plan.activities[index]))
+
+        yield process._transition(self, steps)
+
+    def _p_resolveConflict(self, old, committed, new):
+        # Work items finished and transitions arriving at an and-join
+        # in separate transactions can be merged, unless, together,
+        # they complete the join, which neither transaction started,
+        # or finish the last work items, so neither transaction
+        # finished the activity.  A work item can only be finished
+        # once.
+        committed_items = committed.get('workitems', {})
+        new_items = new.get('workitems', {})
+        for work_item_id in old.get('workitems', ()):
+            if (work_item_id not in committed_items
+                and work_item_id not in new_items):
+                raise ConflictError
+
+        state = mergeState(old, committed, new,
+                           dict(workitems=_mergeRemoved, arrived=_mergeBits))
+        if (not state.get('workitems', True) and committed_items
+            and new_items):
+            raise ConflictError
+        arrived = state.get('arrived', 0)
+        if (arrived != committed.get('arrived', 0)
+            and arrived != new.get('arrived', 0)
+            and arrived == state.get('joinMask', arrived)):
+            raise ConflictError
+        return state
 
     def __repr__(self):
         return "Activity(%r)" % (
@@ -409,7 +1248,11 @@ class Activity(persistent.Persistent):
             self.activity_definition_identifier
             )
 
-class WorkItemFinished:
+class WorkItemFinished(object):
+
+    __slots__ = ('workitem', 'application', 'parameters', 'results')
+
+    level = EVENTS_LIFECYCLE
 
     def __init__(self, workitem, application, parameters, results):
         self.workitem =  workitem
@@ -420,7 +1263,11 @@ class WorkItemFinished:
     def __repr__(self):
         return "WorkItemFinished(%r)" % self.application
 
-class Transition:
+class Transition(object):
+
+    __slots__ = ('from_', 'to')
+
+    level = EVENTS_FULL
 
     def __init__(self, from_, to):
         self.from_ = from_
@@ -429,7 +1276,11 @@ class Transition:
     def __repr__(self):
         return "Transition(%r, %r)" % (self.from_, self.to)
 
-class ActivityFinished:
+class ActivityFinished(object):
+
+    __slots__ = ('activity', )
+
+    level = EVENTS_LIFECYCLE
 
     def __init__(self, activity):
         self.activity = activity
@@ -437,7 +1288,11 @@ class ActivityFinished:
     def __repr__(self):
         return "ActivityFinished(%r)" % self.activity
 
-class ActivityStarted:
+class ActivityStarted(object):
+
+    __slots__ = ('activity', )
+
+    level = EVENTS_LIFECYCLE
 
     def __init__(self, activity):
         self.activity = activity
@@ -445,10 +1300,12 @@ class ActivityStarted:
     def __repr__(self):
         return "ActivityStarted(%r)" % self.activity
 
-class Parameter(object):
+class Parameter(Slotted):
 
     interface.implements(interfaces.IParameterDefinition)
 
+    __slots__ = ('__name__', )
+
     input = output = False
 
     def __init__(self, name):
@@ -456,15 +1313,19 @@ class Parameter(object):
 
 class OutputParameter(Parameter):
 
+    __slots__ = ()
+
     output = True
 
 class InputParameter(Parameter):
 
+    __slots__ = ()
+
     input = True
 
 class InputOutputParameter(InputParameter, OutputParameter):
 
-    pass
+    __slots__ = ()
 
 class Application:
 
@@ -0,0 +1,85 @@
+##############################################################################
+#
+# Copyright (c) 2004 Zope Corporation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Tracking of component-registration changes
+
+Objects that cache the results of component lookups compare the
+registration generation with the one they saw when they cached a
+result, and look the component up again when it has changed.
+
+$Id$
+"""
+
+import itertools
+
+import zope.event
+from zope.component.interfaces import IRegistrationEvent
+
+_counter = itertools.count(1)
+_generation = 0
+
+def generation():
+    """Return a number that changes whenever a registration changes
+    """
+    return _generation
+
+def changed():
+    """Start a new registration generation
+    """
+    global _generation
+    _generation = _counter.next()
+
+def adapterGeneration(adapters, previous=None):
+    """Return a value that changes whenever an adapter registry changes
+
+    Adapter registries count their changes in a private ``_generation``
+    attribute (zope.interface 3.3 and later; checked with 4.7).
+    Registries that verify their lookups don't count changes to the
+    registries they're based on, so the counts of all of the registries
+    in the resolution order are combined.  None is returned if the
+    registries don't count their changes, in which case lookups can't
+    be cached.
+
+    If a previous value for the same registry is given and nothing has
+    changed since, it's returned rather than a new value, so callers
+    can compare with ``is`` and nothing is allocated in the common case.
+    """
+    try:
+        ro = adapters.ro
+        if previous is not None and previous[0] is ro:
+            index = 1
+            for registry in ro:
+                if registry._generation != previous[index]:
+                    break
+                index += 1
+            else:
+                return previous
+        return (ro, ) + tuple([registry._generation for registry in ro])
+    except AttributeError:
+        return None
+
+def registrationChanged(event):
+    if IRegistrationEvent.providedBy(event):
+        changed()
+
+# Registration events are sent through zope.event.  We go first, so we
+# don't get in the way of subscribers that are added and removed later.
+zope.event.subscribers.insert(0, registrationChanged)
+
+try:
+    from zope.testing.cleanup import addCleanUp
+except ImportError:
+    pass
+else:
+    # Registries are reset without events when tests clean up.
+    addCleanUp(changed)
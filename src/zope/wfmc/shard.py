@@ -0,0 +1,206 @@
+##############################################################################
+#
+# Copyright (c) 2004 Zope Corporation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Running process instances in worker processes
+
+Process instances are assigned to shards by a stable hash of process
+identifiers.  Each shard is a worker process that owns its process
+instances.  Requests are routed to the shards over pipes.
+
+$Id$
+"""
+
+import multiprocessing
+import threading
+import zlib
+
+from zope import component, interface
+from zope.wfmc import interfaces
+
+class Context(object):
+    """Context of the process instances run by a shard
+    """
+
+    interface.implements(interfaces.IProcessContext)
+
+    def __init__(self, shard, id):
+        self.shard = shard
+        self.id = id
+
+    def processFinished(self, process, *outputs):
+        del self.shard.processes[self.id]
+        self.shard.finished[self.id] = outputs
+
+class Shard(object):
+    """The process instances run by a worker process
+    """
+
+    def __init__(self):
+        self.processes = {}
+        self.finished = {}
+
+    def start(self, id, process_definition_identifier, arguments):
+        if id in self.processes or id in self.finished:
+            raise interfaces.ProcessError(
+                "Duplicate process id %r" % (id, ))
+        definition = component.getUtility(interfaces.IProcessDefinition,
+                                          process_definition_identifier)
+        process = definition(Context(self, id))
+        self.processes[id] = process
+        try:
+            process.start(*arguments)
+        except:
+            self.processes.pop(id, None)
+            raise
+
+    def workItemFinished(self, id, activity_id, work_item_id, results):
+        activity = self.processes[id].activities[activity_id]
+        work_item = activity.getWorkItem(work_item_id)
+        activity.workItemFinished(work_item, *results)
+
+    def workItems(self, id):
+        process = self.processes.get(id)
+        if process is None:
+            return []
+        result = []
+        for activity_id, activity in sorted(process.activities.items()):
+            node = activity._node()
+            for work_item_id in sorted(activity.workitems):
+                result.append((activity_id, node.id, work_item_id,
+                               node.applications[work_item_id - 1][0]))
+        return result
+
+    def data(self, id):
+        data = self.processes[id].workflowRelevantData
+        return dict([(name, data[name]) for name in data])
+
+    def outputs(self, id):
+        return self.finished.pop(id, None)
+
+def serve(connection, setup):
+    """Serve requests for a shard until the connection is closed
+
+    The setup function is called first.  It's typically used to
+    register process definitions.
+    """
+    if setup is not None:
+        setup()
+
+    shard = Shard()
+    while 1:
+        try:
+            request = connection.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+
+        name, args = request
+        try:
+            result = getattr(shard, name)(*args)
+        except Exception, v:
+            connection.send((False, v))
+        else:
+            connection.send((True, result))
+
+    connection.close()
+
+class ShardedRuntime(object):
+    """Run process instances in a number of worker processes
+
+    Process instances are identified by strings, which determine the
+    shards that own them.  Process definitions must be registered in
+    the workers, either before they are started or by the setup
+    function, which each worker calls once when it starts.
+    """
+
+    def __init__(self, shards, setup=None):
+        self.connections = []
+        self.locks = []
+        self.workers = []
+        for i in range(shards):
+            connection, worker_connection = multiprocessing.Pipe()
+            worker = multiprocessing.Process(
+                target=serve, args=(worker_connection, setup))
+            worker.daemon = True
+            worker.start()
+            worker_connection.close()
+            self.connections.append(connection)
+            self.locks.append(threading.Lock())
+            self.workers.append(worker)
+
+    def shard(self, id):
+        """Return the index of the shard that owns a process instance
+        """
+        return (zlib.crc32(id) & 0xffffffff) % len(self.connections)
+
+    def _call(self, id, name, *args):
+        i = self.shard(id)
+        lock, connection = self.locks[i], self.connections[i]
+        lock.acquire()
+        try:
+            connection.send((name, (id, ) + args))
+            ok, result = connection.recv()
+        finally:
+            lock.release()
+        if not ok:
+            raise result
+        return result
+
+    def start(self, id, process_definition_identifier, *arguments):
+        """Create and start a process instance with the given id
+        """
+        self._call(id, 'start', process_definition_identifier, arguments)
+
+    def workItemFinished(self, id, activity_id, work_item_id, *results):
+        """Finish a work item of a process instance
+
+        Work items are identified by activity and work-item ids, as
+        returned by ``workItems``.
+        """
+        self._call(id, 'workItemFinished', activity_id, work_item_id,
+                   results)
+
+    def workItems(self, id):
+        """Return the unfinished work items of a process instance
+
+        The work items are returned as (activity id, activity
+        definition id, work item id, application id) tuples.
+        """
+        return self._call(id, 'workItems')
+
+    def data(self, id):
+        """Return the workflow-relevant data of a running process instance
+        """
+        return self._call(id, 'data')
+
+    def outputs(self, id):
+        """Return the outputs of a finished process instance, or None
+
+        The outputs are only kept until they're asked for, after which
+        the process instance is forgotten.
+        """
+        return self._call(id, 'outputs')
+
+    def close(self):
+        """Stop the workers
+        """
+        for lock, connection in zip(self.locks, self.connections):
+            lock.acquire()
+            try:
+                connection.send(None)
+                connection.close()
+            finally:
+                lock.release()
+        for worker in self.workers:
+            worker.join()
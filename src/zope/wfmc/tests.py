@@ -16,9 +16,13 @@
 $Id$
 """
 import os
+import threading
 import unittest
+import persistent
 import zope.event
+import zope.interface
 from zope.component import testing
+from zope.wfmc import interfaces, process
 
 def tearDown(test):
     testing.tearDown(test)
@@ -28,6 +32,19 @@ def setUp(test):
     test.globs['this_directory'] = os.path.dirname(__file__)
     testing.setUp(test)
 
+def setUpPools(test):
+    test.globs['threads'] = set(threading.enumerate())
+    testing.setUp(test)
+
+def tearDownPools(test):
+    # Process pools close the queues they send work items through when
+    # they're shut down, but don't wait for the threads feeding the
+    # queues to finish.
+    for thread in set(threading.enumerate()) - test.globs['threads']:
+        if thread.name == 'QueueFeederThread':
+            thread.join(10)
+    tearDown(test)
+
 def test_multiple_input_parameters():
     """
     We'll create a very simple process that inputs two variables and
@@ -196,6 +213,1804 @@ def test_wrong_number_process_args_error_message():
     TypeError: Too many arguments. Expected 0. got 1
     """
 
+def test_compile():
+    """
+    A process definition can be compiled into an execution plan, in
+    which activities are numbered and transitions refer to the indexes
+    of their target activities:
+
+    >>> from zope.wfmc import process
+    >>> pd = process.ProcessDefinition('sample')
+    >>> pd.defineParameters(
+    ...     process.InputParameter('x'),
+    ...     process.OutputParameter('y'),
+    ...     )
+    >>> pd.defineActivities(
+    ...    eek = process.ActivityDefinition(),
+    ...    ook = process.ActivityDefinition(),
+    ...    )
+    >>> pd.defineTransitions(process.TransitionDefinition('eek', 'ook'))
+    >>> pd.defineApplications(
+    ...     eek = process.Application(
+    ...         process.InputParameter('a'),
+    ...         process.OutputParameter('b'),
+    ...         )
+    ...     )
+    >>> pd.activities['eek'].addApplication('eek', ['x', 'y'])
+
+    >>> plan = pd.compile()
+    >>> plan.activities
+    (CompiledActivity('eek'), CompiledActivity('ook'))
+    >>> plan.inputs, plan.outputs
+    (('x',), ('y',))
+
+    >>> eek = plan['eek']
+    >>> eek.index, eek.outgoing
+    (0, ((TransitionDefinition(from='eek', to='ook'), 1),))
+    >>> application, formal, actual, inputs, outputs = eek.applications[0]
+    >>> application, inputs, outputs
+    ('eek', ('x',), ('y',))
+
+    The plan is computed once:
+
+    >>> pd.compile() is plan
+    True
+
+    but changing the definition, or any of its activities, invalidates it:
+
+    >>> pd.activities['ook'].andJoin(True)
+    >>> pd.compile() is plan
+    False
+    >>> pd.compile()['ook'].andJoin, pd.compile()['ook'].joinMask
+    (True, 1)
+
+    Plans aren't saved with their definitions:
+
+    >>> '_plan' in pd.__getstate__()
+    False
+    """
+
+def test_definition_cache():
+    """
+    Process instances look up their definitions as utilities.  The
+    definition is cached, until registrations change:
+
+    >>> from zope.wfmc import process
+    >>> from zope import component
+    >>> pd = process.ProcessDefinition('sample')
+    >>> component.provideUtility(pd, name=pd.id)
+    >>> proc = process.Process(pd, None)
+
+    >>> proc.definition is pd
+    True
+    >>> proc._v_definition[1] is pd
+    True
+
+    >>> pd2 = process.ProcessDefinition('sample')
+    >>> component.provideUtility(pd2, name=pd2.id)
+    >>> proc.definition is pd2
+    True
+
+    The cache is volatile, so it isn't saved with the process:
+
+    >>> '_v_definition' in proc.__getstate__()
+    False
+    """
+
+def test_adapterGeneration():
+    """
+    Adapters found in a registry can be cached until the registry's
+    generation changes.  Local registries often verify their lookups
+    rather than being told about changes to their bases, so changes to
+    the bases are included:
+
+    >>> from zope.interface.adapter import AdapterRegistry
+    >>> from zope.interface.adapter import VerifyingAdapterRegistry
+    >>> from zope.wfmc import registry
+    >>> base = AdapterRegistry()
+    >>> local = VerifyingAdapterRegistry((base, ))
+    >>> generation = registry.adapterGeneration(local)
+    >>> generation == registry.adapterGeneration(local)
+    True
+    >>> base.register([None], interfaces.IParticipant, 'x', 'factory')
+    >>> generation == registry.adapterGeneration(local)
+    False
+
+    Given the previous value, the same value is returned while nothing
+    changes, so that checking doesn't allocate:
+
+    >>> generation = registry.adapterGeneration(local)
+    >>> registry.adapterGeneration(local, generation) is generation
+    True
+    >>> base.register([None], interfaces.IParticipant, 'y', 'factory')
+    >>> changed = registry.adapterGeneration(local, generation)
+    >>> changed is generation, changed == generation
+    (False, False)
+    >>> registry.adapterGeneration(local, changed) is changed
+    True
+
+    Registries that don't count their changes have no generation, so
+    nothing is cached:
+
+    >>> print registry.adapterGeneration(object())
+    None
+    """
+
+def test_wide_and_join():
+    """
+    Process instances keep track of the and-join activities that are
+    waiting for incoming transitions, and the activities record the
+    transitions that have occurred as a bit set.  Let's make a process
+    with lots of parallel branches:
+
+    >>> from zope.wfmc import process
+    >>> from zope import component
+    >>> pd = process.ProcessDefinition('wide')
+    >>> component.provideUtility(pd, name=pd.id)
+    >>> branches = ['b%s' % i for i in range(300)]
+    >>> pd.defineActivities(**dict(
+    ...     [(id, process.ActivityDefinition())
+    ...      for id in ['start', 'join'] + branches]))
+    >>> pd.defineTransitions(*(
+    ...     [process.TransitionDefinition('start', id) for id in branches] +
+    ...     [process.TransitionDefinition(id, 'join') for id in branches]))
+    >>> pd.activities['start'].andSplit(True)
+    >>> pd.activities['join'].andJoin(True)
+
+    >>> started = []
+    >>> def log_started(event):
+    ...     if isinstance(event, process.ActivityStarted):
+    ...         started.append(event.activity.activity_definition_identifier)
+    >>> import zope.event
+    >>> zope.event.subscribers.append(log_started)
+
+    >>> proc = pd()
+    >>> proc.start()
+    >>> len(started), started.count('join')
+    (302, 1)
+    >>> len(proc.activities), len(proc.joins)
+    (0, 0)
+
+    While a join is waiting, it's found through the index:
+
+    >>> pd = process.ProcessDefinition('small')
+    >>> component.provideUtility(pd, name=pd.id)
+    >>> pd.defineActivities(
+    ...     a = process.ActivityDefinition(),
+    ...     b = process.ActivityDefinition(),
+    ...     c = process.ActivityDefinition(),
+    ...     )
+    >>> pd.defineTransitions(
+    ...     process.TransitionDefinition('a', 'c', id='ac'),
+    ...     process.TransitionDefinition('b', 'c', id='bc'),
+    ...     )
+    >>> pd.activities['c'].andJoin(True)
+    >>> ac, bc = pd.transitions
+    >>> proc = process.Process(pd, None)
+    >>> proc.transition(None, [ac])
+    >>> dict(proc.joins)
+    {'c': Activity('small.c')}
+    >>> proc.joins['c'].arrived
+    1
+
+    The same transition can't occur twice:
+
+    >>> proc.joins['c'].start(ac)
+    Traceback (most recent call last):
+    ...
+    ProcessError: Repeated incoming TransitionDefinition(from='a', to='c')
+    with id='ac' while waiting for and completion
+
+    >>> zope.event.subscribers.remove(log_started)
+    """
+
+def test_start_and_join():
+    """
+    A start activity marked as an and-join has no incoming transitions
+    to wait for, so it starts right away:
+
+    >>> from zope.wfmc import process
+    >>> pd = process.ProcessDefinition('p')
+    >>> zope.component.provideUtility(pd, name=pd.id)
+    >>> pd.defineActivities(a = process.ActivityDefinition(),
+    ...                     b = process.ActivityDefinition())
+    >>> pd.defineTransitions(process.TransitionDefinition('a', 'b'))
+    >>> pd.activities['a'].andJoin(True)
+
+    >>> class Context:
+    ...     def processFinished(self, process, *outputs):
+    ...         print 'finished'
+    >>> proc = pd(Context())
+    >>> proc.start()
+    finished
+    >>> len(proc.joins)
+    0
+    """
+
+def test_build():
+    """
+    Large definitions can be built in one step, passing activities,
+    transitions and outgoing-transition references at once:
+
+    >>> from zope.wfmc import process
+    >>> pd = process.ProcessDefinition('sample')
+    >>> pd.build(
+    ...     dict(author=process.ActivityDefinition(),
+    ...          review=process.ActivityDefinition(),
+    ...          publish=process.ActivityDefinition(),
+    ...          reject=process.ActivityDefinition(),
+    ...          ),
+    ...     [process.TransitionDefinition('author', 'review'),
+    ...      process.TransitionDefinition('review', 'reject', id='reject'),
+    ...      process.TransitionDefinition('review', 'publish', id='publish'),
+    ...      ],
+    ...     dict(review=['publish', 'reject']),
+    ...     )
+
+    >>> review = pd.activities['review']
+    >>> review.__name__, review.process
+    ('sample.review', ProcessDefinition('sample'))
+    >>> review.incoming
+    (TransitionDefinition(from='author', to='review'),)
+    >>> review.outgoing
+    (TransitionDefinition(from='review', to='publish'),
+     TransitionDefinition(from='review', to='reject'))
+    >>> len(pd.transitions)
+    3
+
+    The result is the same as defining things one by one:
+
+    >>> pd2 = process.ProcessDefinition('sample')
+    >>> pd2.defineActivities(
+    ...     author=process.ActivityDefinition(),
+    ...     review=process.ActivityDefinition(),
+    ...     publish=process.ActivityDefinition(),
+    ...     reject=process.ActivityDefinition(),
+    ...     )
+    >>> pd2.defineTransitions(*pd.transitions)
+    >>> pd2.activities['review'].addOutgoing('publish')
+    >>> pd2.activities['review'].addOutgoing('reject')
+    >>> pd2.activities['review'].outgoing == review.outgoing
+    True
+
+    Transitions must refer to defined activities:
+
+    >>> pd.build(transitions=[process.TransitionDefinition('review', 'eek')])
+    Traceback (most recent call last):
+    ...
+    KeyError: 'eek'
+    """
+
+def test_events():
+    """
+    Events are only created when someone is listening for them.  Events
+    handled through the component registry are only created if there
+    are handlers for them:
+
+    >>> from zope.wfmc import process, interfaces
+    >>> from zope import component
+    >>> import zope.component.event
+
+    >>> process.subscribed(process.ProcessStarted)
+    False
+    >>> process.subscribed(process.Transition)
+    False
+
+    >>> @component.adapter(interfaces.IProcessStarted)
+    ... def started(event):
+    ...     print event
+    >>> component.provideHandler(started)
+
+    >>> process.subscribed(process.ProcessStarted)
+    True
+    >>> process.subscribed(process.Transition)
+    False
+
+    >>> pd = process.ProcessDefinition('sample')
+    >>> component.provideUtility(pd, name=pd.id)
+    >>> pd.defineActivities(
+    ...    eek = process.ActivityDefinition(),
+    ...    ook = process.ActivityDefinition(),
+    ...    )
+    >>> pd.defineTransitions(process.TransitionDefinition('eek', 'ook'))
+    >>> pd().start()
+    ProcessStarted(Process('sample'))
+
+    Other subscribers get all events, limited by the event level of the
+    process definition:
+
+    >>> import zope.event
+    >>> def log_workflow(event):
+    ...     print event
+    >>> zope.event.subscribers.append(log_workflow)
+    >>> process.subscribed(process.Transition)
+    True
+
+    >>> pd.eventLevel = process.EVENTS_LIFECYCLE
+    >>> pd().start()
+    ProcessStarted(Process('sample'))
+    ProcessStarted(Process('sample'))
+    ActivityStarted(Activity('sample.eek'))
+    ActivityFinished(Activity('sample.eek'))
+    ActivityStarted(Activity('sample.ook'))
+    ActivityFinished(Activity('sample.ook'))
+    ProcessFinished(Process('sample'))
+
+    >>> pd.eventLevel = process.EVENTS_NONE
+    >>> pd().start()
+
+    >>> zope.event.subscribers.remove(log_workflow)
+    >>> process.subscribed(process.Transition)
+    False
+
+    Whether there are handlers is remembered until the registry
+    changes:
+
+    >>> @component.adapter(process.Transition)
+    ... def transitioned(event):
+    ...     pass
+    >>> component.provideHandler(transitioned)
+    >>> process.subscribed(process.Transition)
+    True
+    """
+
+def test_long_automatic_chain():
+    """
+    Activities without work items are finished as soon as they're
+    started.  Process instances execute such chains in a loop, rather
+    than recursively, so long chains don't exhaust the stack:
+
+    >>> from zope.wfmc import process
+    >>> from zope import component
+    >>> import sys
+    >>> n = sys.getrecursionlimit() * 5
+    >>> ids = ['a%s' % i for i in range(n)]
+    >>> pd = process.ProcessDefinition('chain')
+    >>> component.provideUtility(pd, name=pd.id)
+    >>> pd.build(dict([(id, process.ActivityDefinition()) for id in ids]),
+    ...          [process.TransitionDefinition(a, b)
+    ...           for (a, b) in zip(ids, ids[1:])])
+
+    >>> class Context:
+    ...     def processFinished(self, process):
+    ...         print 'finished', len(process.activities)
+
+    >>> proc = pd(Context())
+    >>> proc.start()
+    finished 0
+    >>> proc.nextActivityId == n
+    True
+
+    The order of events is the same as if activities were started and
+    finished recursively.  Work items that finish while they're
+    started are finished, and the process moves on, before their start
+    methods return:
+
+    >>> pd = process.ProcessDefinition('sample')
+    >>> component.provideUtility(pd, name=pd.id)
+    >>> pd.defineActivities(
+    ...    eek = process.ActivityDefinition(),
+    ...    ook = process.ActivityDefinition(),
+    ...    )
+    >>> pd.defineTransitions(process.TransitionDefinition('eek', 'ook'))
+    >>> pd.defineApplications(eek = process.Application())
+    >>> pd.activities['eek'].addApplication('eek')
+
+    >>> from zope.wfmc.attributeintegration import AttributeIntegration
+    >>> integration = AttributeIntegration()
+    >>> pd.integration = integration
+    >>> class Participant(object):
+    ...     def __init__(self, activity):
+    ...         self.activity = activity
+    >>> integration.Participant = Participant
+    >>> class Eek:
+    ...     def __init__(self, participant):
+    ...         self.participant = participant
+    ...     def start(self):
+    ...         print 'start'
+    ...         self.participant.activity.workItemFinished(self)
+    ...         print 'started'
+    >>> integration.eekWorkItem = Eek
+
+    >>> import zope.event
+    >>> def log_workflow(event):
+    ...     print event
+    >>> zope.event.subscribers.append(log_workflow)
+
+    >>> pd().start()
+    ProcessStarted(Process('sample'))
+    Transition(None, Activity('sample.eek'))
+    ActivityStarted(Activity('sample.eek'))
+    start
+    WorkItemFinished('eek')
+    ActivityFinished(Activity('sample.eek'))
+    Transition(Activity('sample.eek'), Activity('sample.ook'))
+    ActivityStarted(Activity('sample.ook'))
+    ActivityFinished(Activity('sample.ook'))
+    ProcessFinished(Process('sample'))
+    started
+
+    >>> zope.event.subscribers.remove(log_workflow)
+
+    Long chains of activities whose work items finish while they're
+    started, like automatic activities, would nest without limit.
+    Beyond ``Process.maxNesting`` levels, the remaining steps are run
+    when the outermost running step continues, so they don't exhaust
+    the stack either:
+
+    >>> pd = process.ProcessDefinition('automatic')
+    >>> component.provideUtility(pd, name=pd.id)
+    >>> pd.build(dict([(id, process.ActivityDefinition()) for id in ids]),
+    ...          [process.TransitionDefinition(a, b)
+    ...           for (a, b) in zip(ids, ids[1:])])
+    >>> pd.defineApplications(eek = process.Application())
+    >>> for id in ids:
+    ...     pd.activities[id].addApplication('eek')
+    >>> class Eek:
+    ...     def __init__(self, participant):
+    ...         self.participant = participant
+    ...     def start(self):
+    ...         self.participant.activity.workItemFinished(self)
+    >>> integration.eekWorkItem = Eek
+    >>> pd.integration = integration
+
+    >>> proc = pd(Context())
+    >>> proc.start()
+    finished 0
+    >>> proc.nextActivityId == n
+    True
+    """
+
+def test_startMany():
+    """
+    Many processes can be started at once, sharing the work of looking
+    up the definition and binding parameters:
+
+    >>> from zope.wfmc import process
+    >>> from zope import component
+    >>> pd = process.ProcessDefinition('sample')
+    >>> component.provideUtility(pd, name=pd.id)
+    >>> pd.defineParameters(
+    ...     process.InputParameter('x'),
+    ...     process.OutputParameter('x'),
+    ...     )
+    >>> pd.defineActivities(
+    ...    eek = process.ActivityDefinition(),
+    ...    ook = process.ActivityDefinition(),
+    ...    )
+    >>> pd.defineTransitions(process.TransitionDefinition('eek', 'ook'))
+
+    >>> class Context:
+    ...     def __init__(self, name):
+    ...         self.name = name
+    ...     def processFinished(self, process, x):
+    ...         print self.name, x
+
+    >>> processes = pd.startMany([Context('a'), Context('b')], [(1, ), (2, )])
+    a 1
+    b 2
+    >>> processes
+    [Process('sample'), Process('sample')]
+    >>> processes[0].definition is pd
+    True
+
+    Processes are created and started through the definition's
+    ``__call__`` and the processes' ``start`` methods, so subclasses
+    can change them:
+
+    >>> class LoggingProcess(process.Process):
+    ...     def start(self, *arguments):
+    ...         print 'starting', arguments
+    ...         process.Process.start(self, *arguments)
+    >>> class LoggingDefinition(process.ProcessDefinition):
+    ...     def __call__(self, context=None):
+    ...         return LoggingProcess(self, self._start, context)
+    >>> pd.__class__ = LoggingDefinition
+    >>> processes = pd.startMany([Context('a')], [(1, )])
+    starting (1,)
+    a 1
+    >>> pd.__class__ = process.ProcessDefinition
+
+    Integration components that can look up the factories a definition
+    needs in advance are bound to the definition once for the batch:
+
+    >>> from zope.wfmc.attributeintegration import TableIntegration
+    >>> pd.defineApplications(app = process.Application())
+    >>> pd.activities['ook'].addApplication('app')
+    >>> class Integration(TableIntegration):
+    ...     def Participant(self, activity):
+    ...         return None
+    ...     class appWorkItem:
+    ...         def __init__(self, participant):
+    ...             pass
+    ...         def start(self):
+    ...             pass
+    >>> pd.integration = Integration()
+    >>> processes = pd.startMany([Context('a'), Context('b')], [(1, ), (2, )])
+    >>> sorted(pd.integration.workitems['sample'])
+    ['app']
+
+    Missing factories are still only reported when they're needed:
+
+    >>> pd.integration = TableIntegration()
+    >>> pd.startMany([Context('a')], [(1, )])
+    Traceback (most recent call last):
+    ...
+    AttributeError: TableIntegration instance has no attribute 'Participant'
+
+    There must be an argument row for each context:
+
+    >>> pd.startMany([Context('a'), Context('b')], [(1, )])
+    Traceback (most recent call last):
+    ...
+    TypeError: Expected 2 argument rows. got 1
+    """
+
+def test_workItemsFinished():
+    """
+    Work items of many activities and processes can be finished at once:
+
+    >>> from zope.wfmc import process
+    >>> from zope import component
+    >>> pd = process.ProcessDefinition('sample')
+    >>> component.provideUtility(pd, name=pd.id)
+    >>> pd.defineActivities(
+    ...    eek = process.ActivityDefinition(),
+    ...    ook = process.ActivityDefinition(),
+    ...    )
+    >>> pd.defineTransitions(process.TransitionDefinition('eek', 'ook'))
+    >>> pd.defineApplications(
+    ...     a = process.Application(process.OutputParameter('x')),
+    ...     b = process.Application(process.OutputParameter('x')),
+    ...     )
+    >>> pd.activities['eek'].addApplication('a', ['a'])
+    >>> pd.activities['eek'].addApplication('b', ['b'])
+
+    >>> from zope.wfmc.attributeintegration import AttributeIntegration
+    >>> integration = AttributeIntegration()
+    >>> pd.integration = integration
+    >>> class Participant(object):
+    ...     def __init__(self, activity):
+    ...         self.activity = activity
+    >>> integration.Participant = Participant
+    >>> work_list = []
+    >>> class WorkItem:
+    ...     def __init__(self, participant):
+    ...         self.activity = participant.activity
+    ...         work_list.append(self)
+    ...     def start(self):
+    ...         pass
+    >>> integration.aWorkItem = integration.bWorkItem = WorkItem
+
+    >>> class Context:
+    ...     def processFinished(self, process):
+    ...         data = process.workflowRelevantData
+    ...         print 'finished', data.a, data.b
+
+    >>> processes = pd.startMany([Context(), Context()])
+    >>> len(work_list)
+    4
+
+    >>> import zope.event
+    >>> def log_workflow(event):
+    ...     print event
+    >>> zope.event.subscribers.append(log_workflow)
+
+    All of the results for a process are written before any activities
+    are finished:
+
+    >>> process.workItemsFinished([(item.activity, item, (i, ))
+    ...                            for (i, item) in enumerate(work_list)])
+    WorkItemFinished('a')
+    WorkItemFinished('b')
+    ActivityFinished(Activity('sample.eek'))
+    Transition(Activity('sample.eek'), Activity('sample.ook'))
+    ActivityStarted(Activity('sample.ook'))
+    ActivityFinished(Activity('sample.ook'))
+    finished 0 1
+    ProcessFinished(Process('sample'))
+    WorkItemFinished('a')
+    WorkItemFinished('b')
+    ActivityFinished(Activity('sample.eek'))
+    Transition(Activity('sample.eek'), Activity('sample.ook'))
+    ActivityStarted(Activity('sample.ook'))
+    ActivityFinished(Activity('sample.ook'))
+    finished 2 3
+    ProcessFinished(Process('sample'))
+
+    Nothing is changed if there's a problem with any of the results:
+
+    >>> proc = pd()
+    >>> proc.start()
+    ProcessStarted(Process('sample'))
+    Transition(None, Activity('sample.eek'))
+    ActivityStarted(Activity('sample.eek'))
+    >>> a, b = work_list[-2:]
+    >>> process.workItemsFinished([(a.activity, a, (1, )),
+    ...                            (b.activity, b, (1, 2))])
+    Traceback (most recent call last):
+    ...
+    TypeError: Too many results
+    >>> process.workItemsFinished([(a.activity, a, (1, )),
+    ...                            (a.activity, a, (1, ))])
+    Traceback (most recent call last):
+    ...
+    ProcessError: Unknown or repeated work item ...
+    >>> sorted(a.activity.workitems)
+    [1, 2]
+
+    >>> zope.event.subscribers.remove(log_workflow)
+    """
+
+class StoredWorkItem(persistent.Persistent):
+    """Work item that can be stored in a database
+    """
+
+    def __init__(self, participant):
+        pass
+
+    def start(self):
+        pass
+
+class InlineWorkItem(object):
+    """Work item that is stored in its activity's record
+    """
+
+    def __init__(self, participant):
+        pass
+
+    def start(self):
+        pass
+
+class DeadlineActivity(process.ActivityDefinition):
+    """Activity definition with an instance dictionary
+    """
+
+class NamedTransition(process.TransitionDefinition):
+    """Transition definition with an instance dictionary
+    """
+
+class Doubler(object):
+    """Automatic work item that can be started in a process pool
+    """
+
+    zope.interface.implements(interfaces.IAutomaticWorkItem)
+
+    def __init__(self, participant):
+        pass
+
+    def start(self, x):
+        return x * 2, os.getpid()
+
+def test_persistence():
+    """
+    A process's activities, waiting joins and activity-id counter are
+    stored separately from the process, so transitions don't change the
+    process record.
+
+    >>> from zope.wfmc import process
+    >>> from zope.wfmc.attributeintegration import AttributeIntegration
+    >>> from zope.wfmc.tests import StoredWorkItem
+    >>> from zope import component
+    >>> pd = process.ProcessDefinition('sample')
+    >>> component.provideUtility(pd, name=pd.id)
+    >>> pd.defineActivities(
+    ...    eek = process.ActivityDefinition(),
+    ...    ook = process.ActivityDefinition(),
+    ...    )
+    >>> pd.defineTransitions(process.TransitionDefinition('eek', 'ook'))
+    >>> pd.defineApplications(a = process.Application())
+    >>> pd.activities['eek'].addApplication('a')
+    >>> pd.activities['ook'].addApplication('a')
+    >>> pd.integration = integration = AttributeIntegration()
+    >>> integration.Participant = lambda activity: None
+    >>> integration.aWorkItem = StoredWorkItem
+
+    >>> import transaction
+    >>> from ZODB.DB import DB
+    >>> db = DB(None)
+    >>> conn = db.open()
+    >>> proc = conn.root()['proc'] = pd()
+    >>> proc.start()
+    >>> transaction.commit()
+
+    >>> [eek] = proc.activities.values()
+    >>> work_item = eek.getWorkItem(1)
+    >>> eek.workItemFinished(work_item)
+    >>> [ook] = proc.activities.values()
+    >>> ook
+    Activity('sample.ook')
+    >>> proc._p_changed, proc.activities._p_changed
+    (False, True)
+    >>> proc.nextActivityId
+    2
+    >>> transaction.commit()
+
+    Processes stored by older versions are converted when they next
+    make a transition:
+
+    >>> state = proc.__getstate__()
+    >>> state['activities'] = dict(proc.activities)
+    >>> state['nextActivityId'] = proc.nextActivityId
+    >>> del state['activityIds'], state['joins']
+    >>> proc.__setstate__(state)
+    >>> proc.nextActivityId
+    2
+
+    >>> ook.workItemFinished(ook.getWorkItem(1))
+    >>> proc.activities.__class__.__name__, proc.nextActivityId
+    ('Activities', 2)
+    >>> len(proc.activities)
+    0
+    >>> proc._p_changed
+    True
+
+    >>> transaction.abort()
+
+    Older and-join activities that are waiting for transitions record
+    the transitions that have arrived in a tuple.  They're converted
+    to bit sets and indexed as waiting joins:
+
+    >>> pd = process.ProcessDefinition('joining')
+    >>> component.provideUtility(pd, name=pd.id)
+    >>> pd.defineActivities(
+    ...    split = process.ActivityDefinition(),
+    ...    left = process.ActivityDefinition(),
+    ...    right = process.ActivityDefinition(),
+    ...    join = process.ActivityDefinition(),
+    ...    )
+    >>> pd.activities['split'].andSplit(True)
+    >>> pd.activities['join'].andJoin(True)
+    >>> pd.defineTransitions(
+    ...     process.TransitionDefinition('split', 'left'),
+    ...     process.TransitionDefinition('split', 'right'),
+    ...     process.TransitionDefinition('left', 'join', id='l'),
+    ...     process.TransitionDefinition('right', 'join', id='r'),
+    ...     )
+    >>> pd.defineApplications(a = process.Application())
+    >>> pd.activities['left'].addApplication('a')
+    >>> pd.activities['right'].addApplication('a')
+    >>> pd.integration = integration
+
+    >>> proc = conn.root()['proc'] = pd()
+    >>> proc.start()
+    >>> left, right = [a for a in proc.activities.values()
+    ...                if a.getWorkItem(1)]
+    >>> left.workItemFinished(left.getWorkItem(1))
+    >>> [join] = proc.joins.values()
+    >>> transaction.commit()
+
+    >>> import cPickle
+    >>> [transition] = [t for t in pd.transitions if t.id == 'l']
+    >>> del join.arrived, join.joinMask
+    >>> join.incoming = (cPickle.loads(cPickle.dumps(transition)), )
+    >>> state = proc.__getstate__()
+    >>> state['activities'] = dict(proc.activities)
+    >>> state['nextActivityId'] = proc.nextActivityId
+    >>> del state['activityIds'], state['joins']
+    >>> proc.__setstate__(state)
+
+    >>> right.workItemFinished(right.getWorkItem(1))
+    >>> len(proc.activities), len(proc.joins)
+    (0, 0)
+    >>> 'incoming' in join.__dict__, join.arrived, join.joinMask
+    (False, 3, 3)
+
+    >>> transaction.abort()
+    >>> conn.close()
+    >>> db.close()
+    """
+
+def test_conflict_resolution():
+    """
+    Work items of parallel branches can be finished in concurrent
+    transactions.  Let's define a process that splits into five
+    branches, each of which sets a variable, and joins them again:
+
+    >>> from zope.wfmc import process
+    >>> from zope.wfmc.attributeintegration import AttributeIntegration
+    >>> from zope.wfmc.tests import StoredWorkItem
+    >>> from zope import component
+    >>> pd = process.ProcessDefinition('sample')
+    >>> component.provideUtility(pd, name=pd.id)
+    >>> branches = 'abcde'
+    >>> pd.defineActivities(split=process.ActivityDefinition(),
+    ...                     join=process.ActivityDefinition())
+    >>> pd.defineActivities(**dict((b, process.ActivityDefinition())
+    ...                            for b in branches))
+    >>> pd.activities['split'].andSplit(True)
+    >>> pd.activities['join'].andJoin(True)
+    >>> pd.defineTransitions(*(
+    ...     [process.TransitionDefinition('split', b) for b in branches] +
+    ...     [process.TransitionDefinition(b, 'join') for b in branches]))
+    >>> pd.defineApplications(
+    ...     set = process.Application(process.OutputParameter('x')))
+    >>> for b in branches:
+    ...     pd.activities[b].addApplication('set', [b])
+    >>> pd.integration = integration = AttributeIntegration()
+    >>> integration.Participant = lambda activity: None
+    >>> integration.setWorkItem = StoredWorkItem
+
+    >>> import os, tempfile, transaction
+    >>> from ZODB.DB import DB
+    >>> from ZODB.FileStorage import FileStorage
+    >>> directory = tempfile.mkdtemp()
+    >>> db = DB(FileStorage(os.path.join(directory, 'Data.fs')))
+    >>> tm1 = transaction.TransactionManager()
+    >>> conn1 = db.open(tm1)
+    >>> proc = conn1.root()['proc'] = pd()
+    >>> proc.start()
+    >>> tm1.commit()
+
+    >>> def finish(proc, branch):
+    ...     [activity] = [a for a in proc.activities.values()
+    ...                   if a.activity_definition_identifier == branch]
+    ...     activity.workItemFinished(activity.getWorkItem(1), branch)
+
+    We'll finish the first branch, which creates the join activity:
+
+    >>> finish(proc, 'a')
+    >>> tm1.commit()
+
+    Now, we'll finish two more branches in separate transactions,
+    including the oldest running one:
+
+    >>> tm2 = transaction.TransactionManager()
+    >>> conn2 = db.open(tm2)
+    >>> proc2 = conn2.root()['proc']
+
+    >>> finish(proc, 'b')
+    >>> finish(proc2, 'c')
+    >>> tm1.commit()
+    >>> tm2.commit()
+
+    The changes were merged:
+
+    >>> conn1.sync()
+    >>> sorted(a.activity_definition_identifier
+    ...        for a in proc.activities.values())
+    ['d', 'e', 'join']
+    >>> join = proc.joins['join']
+    >>> join.arrived, join.joinMask
+    (7, 31)
+    >>> data = proc.workflowRelevantData
+    >>> data.a, data.b, data.c
+    ('a', 'b', 'c')
+
+    Finishing the last activities concurrently can't be merged, because
+    neither transaction finishes the process:
+
+    >>> old = dict(data={1: 'x', 2: 'y'})
+    >>> proc.activities._p_resolveConflict(old, dict(data={1: 'x'}),
+    ...                                    dict(data={2: 'y'}))
+    Traceback (most recent call last):
+    ...
+    ConflictError: database conflict error
+
+    Arrivals that, together, complete a join can't be merged, because
+    neither transaction starts the joined activity:
+
+    >>> old = join.__getstate__()
+    >>> join._p_resolveConflict(old, dict(old, arrived=15),
+    ...                         dict(old, arrived=29))
+    Traceback (most recent call last):
+    ...
+    ConflictError: database conflict error
+
+    Finishing the same work item twice can't be merged either:
+
+    >>> [e] = [a for a in proc.activities.values()
+    ...        if a.activity_definition_identifier == 'e']
+    >>> old = e.__getstate__()
+    >>> e._p_resolveConflict(old, dict(old, workitems={}),
+    ...                      dict(old, workitems={}))
+    Traceback (most recent call last):
+    ...
+    ConflictError: database conflict error
+
+    Changes to different process attributes are merged, even though
+    the process holds non-persistent objects, like its start
+    transition, that are loaded as new copies for conflict resolution:
+
+    >>> tm1.abort()
+    >>> conn2.sync()
+    >>> proc.startTransition is not None
+    True
+    >>> proc.foo = 1
+    >>> proc2.bar = 2
+    >>> tm1.commit()
+    >>> tm2.commit()
+    >>> conn1.sync()
+    >>> proc.foo, proc.bar
+    (1, 2)
+
+    Work items needn't be persistent.  Let's give a branch a second
+    work item and finish both of them, and two more branches, in
+    separate transactions, using non-persistent work items:
+
+    >>> from zope.wfmc.tests import InlineWorkItem
+    >>> integration.setWorkItem = InlineWorkItem
+    >>> pd.activities['b'].addApplication('set', ['b2'])
+    >>> pd.activities['b'].addApplication('set', ['b3'])
+    >>> proc = conn1.root()['proc'] = pd()
+    >>> proc.start()
+    >>> finish(proc, 'a')
+    >>> tm1.commit()
+    >>> conn2.sync()
+    >>> proc2 = conn2.root()['proc']
+
+    >>> [b] = [a for a in proc.activities.values()
+    ...        if a.activity_definition_identifier == 'b']
+    >>> [b2] = [a for a in proc2.activities.values()
+    ...         if a.activity_definition_identifier == 'b']
+    >>> b.workItemFinished(b.getWorkItem(1), 'b1')
+    >>> b2.workItemFinished(b2.getWorkItem(2), 'b2')
+    >>> tm1.commit()
+    >>> tm2.commit()
+    >>> conn1.sync()
+    >>> sorted(b.workitems)
+    [3]
+
+    Finishing the last work items concurrently can't be merged, because
+    neither transaction finishes the activity:
+
+    >>> old = b.__getstate__()
+    >>> b._p_resolveConflict(old, dict(old, workitems={1: None}),
+    ...                      dict(old, workitems={3: None}))
+    Traceback (most recent call last):
+    ...
+    ConflictError: database conflict error
+
+    >>> finish(proc, 'c')
+    >>> finish(proc2, 'd')
+    >>> tm1.commit()
+    >>> tm2.commit()
+    >>> conn1.sync()
+    >>> proc.joins['join'].arrived
+    13
+    >>> sorted(a.activity_definition_identifier
+    ...        for a in proc.activities.values())
+    ['b', 'e', 'join']
+
+    >>> tm1.abort()
+    >>> conn1.close()
+    >>> conn2.close()
+    >>> db.close()
+    >>> import shutil
+    >>> shutil.rmtree(directory)
+    """
+
+def test_workflow_data():
+    """
+    Workflow data provide variables as attributes and items:
+
+    >>> from zope.wfmc import process
+    >>> data = process.WorkflowData()
+    >>> data.approved = True
+    >>> data.approved, data['approved']
+    (True, True)
+    >>> list(data)
+    ['approved']
+    >>> data.missing
+    Traceback (most recent call last):
+    ...
+    AttributeError: missing
+
+    >>> from zope.wfmc.xpdl import TextCondition
+    >>> TextCondition('approved and not rejected')(data)
+    Traceback (most recent call last):
+    ...
+    NameError: name 'rejected' is not defined
+    >>> data.rejected = False
+    >>> TextCondition('approved and not rejected')(data)
+    True
+
+    Large strings are stored in records of their own, which are reused
+    when the variables are changed:
+
+    >>> import transaction
+    >>> from ZODB.DB import DB
+    >>> db = DB(None)
+    >>> conn = db.open()
+    >>> conn.root()['data'] = data
+    >>> data.document = 'x' * (data.inlineLimit + 1)
+    >>> holder = data._variables['document']
+    >>> holder
+    <zope.wfmc.process.Variable object at ...>
+    >>> transaction.commit()
+
+    so changing other variables doesn't rewrite them:
+
+    >>> data.approved = False
+    >>> data._variables._p_changed, holder._p_changed, data._p_changed
+    (True, False, False)
+    >>> transaction.commit()
+
+    >>> data.document = 'y' * (data.inlineLimit + 1)
+    >>> data._variables['document'] is holder
+    True
+    >>> data._variables._p_changed, holder._p_changed
+    (False, True)
+    >>> data.document == 'y' * (data.inlineLimit + 1)
+    True
+    >>> transaction.commit()
+
+    Other large values, like documents made of lists and
+    dictionaries, are stored in records of their own too:
+
+    >>> data.document = {'pages': [str(i) * 100 for i in range(20)]}
+    >>> data._variables['document'] is holder
+    True
+    >>> data.document['pages'][1] == '1' * 100
+    True
+    >>> data.reviewers = ['bob', 'sally']
+    >>> data._variables['reviewers']
+    ['bob', 'sally']
+
+    Persistent values are stored in records of their own anyway, and
+    values that can't be pickled can't be stored at all, so they're
+    kept in place:
+
+    >>> data.reviewers = process.WorkflowData()
+    >>> data._variables['reviewers']
+    <zope.wfmc.process.WorkflowData object at ...>
+    >>> data.check = [lambda data: True] * 1000
+    >>> len(data._variables['check'])
+    1000
+    >>> del data.check, data.reviewers
+    >>> transaction.commit()
+
+    >>> del data.document
+    >>> list(data)
+    ['approved', 'rejected']
+
+    Data stored by older versions kept variables in their instance
+    dictionaries. They're converted when a variable is next set:
+
+    >>> old = process.WorkflowData()
+    >>> old.__setstate__({'author': 'bob', 'approved': True})
+    >>> old.author, old['approved'], sorted(old)
+    ('bob', True, ['approved', 'author'])
+    >>> old.approved = False
+    >>> old.__getstate__().keys()
+    ['_variables']
+    >>> old.author, old['approved'], sorted(old)
+    ('bob', False, ['approved', 'author'])
+
+    >>> transaction.abort()
+    >>> conn.close()
+    >>> db.close()
+    """
+
+def test_work_item_storage():
+    """
+    Activities only store their work items, keyed by work-item id.
+    Applications and parameters are found in the definition:
+
+    >>> from zope.wfmc import process
+    >>> from zope.wfmc.attributeintegration import AttributeIntegration
+    >>> from zope import component
+    >>> pd = process.ProcessDefinition('sample')
+    >>> component.provideUtility(pd, name=pd.id)
+    >>> pd.defineActivities(
+    ...    eek = process.ActivityDefinition(),
+    ...    ook = process.ActivityDefinition(),
+    ...    )
+    >>> pd.defineTransitions(process.TransitionDefinition('eek', 'ook'))
+    >>> pd.defineApplications(
+    ...     a = process.Application(process.OutputParameter('x')))
+    >>> pd.activities['eek'].addApplication('a', ['x'])
+    >>> pd.activities['eek'].addApplication('a', ['y'])
+    >>> pd.integration = integration = AttributeIntegration()
+    >>> integration.Participant = lambda activity: None
+    >>> class WorkItem:
+    ...     def __init__(self, participant):
+    ...         pass
+    ...     def start(self):
+    ...         pass
+    ...     def __repr__(self):
+    ...         return 'WorkItem(%s)' % self.id
+    >>> integration.aWorkItem = WorkItem
+
+    >>> proc = pd()
+    >>> proc.start()
+    >>> [activity] = proc.activities.values()
+    >>> activity.workitems
+    {1: WorkItem(1), 2: WorkItem(2)}
+    >>> activity.getWorkItem(2)
+    WorkItem(2)
+
+    Activities stored by older versions kept the application and
+    parameters with each work item:
+
+    >>> activity.workitems[2] = activity.workitems[2], 'a', (), ('y', )
+    >>> activity.getWorkItem(2)
+    WorkItem(2)
+
+    >>> import zope.event
+    >>> def log_workflow(event):
+    ...     if isinstance(event, process.WorkItemFinished):
+    ...         print event, event.parameters, event.results
+    >>> zope.event.subscribers.append(log_workflow)
+
+    >>> activity.workItemFinished(activity.getWorkItem(2), 2)
+    WorkItemFinished('a') ('y',) (2,)
+    >>> activity.workItemFinished(activity.getWorkItem(1), 1)
+    WorkItemFinished('a') ('x',) (1,)
+    >>> data = proc.workflowRelevantData
+    >>> data.x, data.y
+    (1, 2)
+
+    >>> zope.event.subscribers.remove(log_workflow)
+    """
+
+def test_slots():
+    """
+    Definitions, parameters and events don't have instance
+    dictionaries:
+
+    >>> from zope.wfmc import process, interfaces
+    >>> pd = process.ProcessDefinition('sample')
+    >>> pd.defineActivities(eek = process.ActivityDefinition('Eek'))
+    >>> eek = pd.activities['eek']
+    >>> transition = process.TransitionDefinition('eek', 'eek')
+    >>> parameter = process.InputOutputParameter('x')
+    >>> event = process.Transition(None, None)
+    >>> [hasattr(ob, '__dict__')
+    ...  for ob in (eek, transition, parameter, event)]
+    [False, False, False, False]
+
+    >>> interfaces.IActivityDefinition.providedBy(eek)
+    True
+    >>> interfaces.ITransitionDefinition.providedBy(transition)
+    True
+    >>> interfaces.IParameterDefinition.providedBy(parameter)
+    True
+    >>> parameter.input, parameter.output
+    (True, True)
+
+    They can be pickled with any protocol:
+
+    >>> import pickle
+    >>> for protocol in range(3):
+    ...     copy = pickle.loads(pickle.dumps(transition, protocol))
+    ...     print copy, copy.condition is process.always_true
+    TransitionDefinition(from='eek', to='eek') True
+    TransitionDefinition(from='eek', to='eek') True
+    TransitionDefinition(from='eek', to='eek') True
+
+    >>> copy = pickle.loads(pickle.dumps(eek))
+    >>> copy, copy.id, copy.process
+    (<ActivityDefinition 'Eek'>, 'eek', ProcessDefinition('sample'))
+
+    Attributes of subclasses that don't define slots are pickled too:
+
+    >>> from zope.wfmc.tests import DeadlineActivity, NamedTransition
+    >>> pd.defineActivities(ook = DeadlineActivity('Ook'))
+    >>> pd.activities['ook'].deadline = 5
+    >>> copy = pickle.loads(pickle.dumps(pd.activities['ook']))
+    >>> copy, copy.id, copy.deadline
+    (<ActivityDefinition 'Ook'>, 'ook', 5)
+    >>> transition = NamedTransition('eek', 'ook')
+    >>> transition.label = 'Go'
+    >>> for protocol in range(3):
+    ...     copy = pickle.loads(pickle.dumps(transition, protocol))
+    ...     print copy, copy.label
+    TransitionDefinition(from='eek', to='ook') Go
+    TransitionDefinition(from='eek', to='ook') Go
+    TransitionDefinition(from='eek', to='ook') Go
+
+    Activity definitions stored by older versions didn't store the
+    default process and performer:
+
+    >>> state = eek.__getstate__()
+    >>> del state['process'], state['performer']
+    >>> old = process.ActivityDefinition.__new__(process.ActivityDefinition)
+    >>> old.__setstate__(state)
+    >>> old, old.process, old.performer
+    (<ActivityDefinition 'Eek'>, None, '')
+    """
+
+def test_condition_cache():
+    """
+    Text conditions with the same source share compiled code, even
+    after they've been unpickled:
+
+    >>> import pickle
+    >>> from zope.wfmc import xpdl
+    >>> condition = xpdl.TextCondition('(x > 1)')
+    >>> copy = pickle.loads(pickle.dumps(condition))
+    >>> copy.__dict__
+    {'source': '(x > 1)'}
+    >>> copy({'x': 2}), condition({'x': 1})
+    (True, False)
+    >>> copy._v_compiled is condition._v_compiled
+    True
+
+    The number of cached conditions is limited.  The least recently
+    used conditions are dropped:
+
+    >>> size = xpdl.conditionCacheSize
+    >>> xpdl.conditionCacheSize = 2
+    >>> xpdl.compileCondition('(x > 1)') is condition._v_compiled
+    True
+    >>> for i in range(2):
+    ...     ignored = xpdl.compileCondition('(x > %s)' % (i + 2))
+    >>> xpdl.compileCondition('(x > 1)') is condition._v_compiled
+    False
+    >>> xpdl.conditionCacheSize = size
+    """
+
+def test_condition_compiler():
+    """
+    Conditions are compiled to functions of workflow data:
+
+    >>> from zope.wfmc import xpdl, process
+    >>> data = process.WorkflowData()
+    >>> data.amount = 150
+    >>> data.state = 'approved'
+    >>> data.reviewers = ('bob', 'sally')
+    >>> data.review = process.WorkflowData()
+    >>> data.review.changes = 0
+
+    >>> def check(source):
+    ...     return xpdl.compileExpression(source)(data)
+
+    >>> check('amount > 100 and state == "approved"')
+    True
+    >>> check('100 < amount <= 200'), check('0 < amount < 100')
+    (True, False)
+    >>> check('not review.changes or amount - 50 > 200')
+    True
+    >>> check('"bob" in reviewers and "ted" not in reviewers')
+    True
+    >>> check('state in ("approved", "rejected")')
+    True
+    >>> check('review.changes is None or -amount')
+    -150
+    >>> check('  amount % 7 == 3 and True')
+    True
+    >>> check('missing')
+    Traceback (most recent call last):
+    ...
+    NameError: name 'missing' is not defined
+
+    Data that aren't mappings, like objects with slots, provide
+    variables as attributes:
+
+    >>> class Data(object):
+    ...     __slots__ = ('amount', '_secret')
+    >>> data = Data()
+    >>> data.amount = 150
+    >>> data._secret = 42
+    >>> check('amount > 100')
+    True
+    >>> check('missing')
+    Traceback (most recent call last):
+    ...
+    NameError: name 'missing' is not defined
+    >>> check('_secret')
+    Traceback (most recent call last):
+    ...
+    NameError: name '_secret' is not defined
+    >>> class OldData:
+    ...     amount = 150
+    >>> xpdl.TextCondition('amount > 100')(OldData())
+    True
+
+    Anything else is rejected when conditions are compiled:
+
+    >>> xpdl.compileExpression('open("/etc/passwd")')
+    Traceback (most recent call last):
+    ...
+    SyntaxError: Call isn't allowed in conditions
+    >>> xpdl.compileExpression('reviewers[0]')
+    Traceback (most recent call last):
+    ...
+    SyntaxError: Subscript isn't allowed in conditions
+    >>> xpdl.compileExpression('state.__class__')
+    Traceback (most recent call last):
+    ...
+    SyntaxError: Private attribute '__class__' isn't allowed in conditions
+    >>> xpdl.compileExpression('amount ** 2')
+    Traceback (most recent call last):
+    ...
+    SyntaxError: Pow isn't allowed in conditions
+    >>> xpdl.TextCondition('(lambda: 1)')
+    Traceback (most recent call last):
+    ...
+    SyntaxError: Lambda isn't allowed in conditions
+    >>> xpdl.TextCondition('(amount >)')
+    Traceback (most recent call last):
+    ...
+    SyntaxError: unexpected EOF while parsing
+    """
+
+def test_decision_tables():
+    """
+    The outgoing transitions of xor splits are usually tested in order
+    until a condition is true.  Consecutive transitions whose
+    conditions compare the same variable with constants are chosen by
+    looking the variable's value up in a table instead:
+
+    >>> from zope.wfmc import process
+    >>> from zope.wfmc.xpdl import TextCondition
+    >>> pd = process.ProcessDefinition('routing')
+    >>> pd.defineActivities(route = process.ActivityDefinition(),
+    ...                     eu = process.ActivityDefinition(),
+    ...                     us = process.ActivityDefinition(),
+    ...                     asia = process.ActivityDefinition(),
+    ...                     big = process.ActivityDefinition(),
+    ...                     other = process.ActivityDefinition())
+    >>> def transition(to, source):
+    ...     return process.TransitionDefinition(
+    ...         'route', to, TextCondition(source), id=to + ' ' + source)
+    >>> pd.defineTransitions(
+    ...     transition('big', 'amount > 1000'),
+    ...     transition('eu', 'region == "EU"'),
+    ...     transition('us', '"US" == region'),
+    ...     transition('eu', 'region == "UK"'),
+    ...     transition('asia', 'region == 81'),
+    ...     transition('us', 'region == "EU"'),
+    ...     transition('us', 'amount == 0'),
+    ...     transition('other', 'True'),
+    ...     )
+
+    >>> node = pd.compile()['route']
+    >>> for name, table, run in node.choices:
+    ...     print name, table and sorted(table), [t.id for (t, i) in run]
+    None None ['big amount > 1000']
+    region [81, 'EU', 'UK', 'US'] ['eu region == "EU"', 'us "US" == region',
+                                   'eu region == "UK"', 'asia region == 81',
+                                   'us region == "EU"']
+    None None ['us amount == 0', 'other True']
+
+    The first matching transition in declaration order is chosen:
+
+    >>> data = process.WorkflowData()
+    >>> data.amount = 10
+    >>> def choose():
+    ...     transition, index = node.choose(data)
+    ...     assert pd.compile().activities[index].id == transition.to
+    ...     return transition.id
+    >>> for region in ('EU', 'US', 'UK', 81, 'XX', ['EU']):
+    ...     data.region = region
+    ...     print choose()
+    eu region == "EU"
+    us "US" == region
+    eu region == "UK"
+    asia region == 81
+    other True
+    other True
+    >>> data.amount = 2000
+    >>> choose()
+    'big amount > 1000'
+
+    If the variable isn't defined, the conditions are evaluated:
+
+    >>> data = process.WorkflowData()
+    >>> data.amount = 1
+    >>> choose()
+    Traceback (most recent call last):
+    ...
+    NameError: name 'region' is not defined
+
+    And splits don't use tables:
+
+    >>> pd.activities['route'].andSplit(True)
+    >>> pd.compile()['route'].choices
+    ()
+    """
+
+def test_xpdl_reader():
+    """
+    Packages are read with expat directly.  The handler can still be
+    used with SAX, which gives the same package:
+
+    >>> import os, xml.sax
+    >>> from zope.wfmc import xpdl
+    >>> def saxRead(file):
+    ...     package = xpdl.Package()
+    ...     parser = xml.sax.make_parser()
+    ...     parser.setContentHandler(xpdl.XPDLHandler(package))
+    ...     parser.setFeature(xml.sax.handler.feature_namespaces, True)
+    ...     parser.parse(file)
+    ...     return package
+
+    >>> def dump(package):
+    ...     result = []
+    ...     for pid, pd in sorted(package.items()):
+    ...         result.append((pid, pd.__name__, pd.description,
+    ...                        sorted(pd.participants),
+    ...                        sorted(pd.applications),
+    ...                        [(p.__class__.__name__, p.__name__)
+    ...                         for p in pd.parameters]))
+    ...         for aid, activity in sorted(pd.activities.items()):
+    ...             result.append((aid, activity.__name__,
+    ...                            activity.description, activity.performer,
+    ...                            activity.andJoinSetting,
+    ...                            activity.andSplitSetting,
+    ...                            [(a[0], a[-1])
+    ...                             for a in activity.applications],
+    ...                            [t.id for t in activity.outgoing]))
+    ...         for t in pd.transitions:
+    ...             result.append((t.id, t.from_, t.to, t.__name__,
+    ...                            t.description,
+    ...                            getattr(t.condition, 'source', None)))
+    ...     for name, value in sorted(package.participants.items()):
+    ...         result.append((name, value.__name__, value.description))
+    ...     for name, value in sorted(package.applications.items()):
+    ...         result.append((name, getattr(value, '__name__', None),
+    ...                        getattr(value, 'description', None),
+    ...                        [(p.__class__.__name__, p.__name__)
+    ...                         for p in value.parameters]))
+    ...     return repr(result)
+
+    >>> path = os.path.join(os.path.dirname(xpdl.__file__),
+    ...                     'publication.xpdl')
+    >>> package = xpdl.read(open(path))
+    >>> dump(package) == dump(saxRead(open(path)))
+    True
+    >>> len(package[u'Publication'].activities)
+    9
+
+    Processes share the applications and participants of their
+    package:
+
+    >>> pd = package[u'Publication']
+    >>> pd.applications['publish'] is package.applications['publish']
+    True
+    >>> pd.participants['System'] is package.participants['System']
+    True
+    >>> 'tech1' in package.participants, 'tech1' in pd.participants
+    (False, True)
+
+    Packages can be read lazily.  The processes are only indexed, and
+    are read when they're looked up:
+
+    >>> package = xpdl.read(open(path), lazy=True)
+    >>> package.keys(), package.unread.keys()
+    ([u'Publication'], [u'Publication'])
+    >>> dump(package) == dump(saxRead(open(path)))
+    True
+    >>> package.unread
+    {}
+
+    Lazy packages aren't dictionaries, so processes can't be copied out
+    of them unread:
+
+    >>> package = xpdl.read(open(path), lazy=True)
+    >>> isinstance(package, dict)
+    False
+    >>> dict(package), package.copy()
+    ({u'Publication': ProcessDefinition(u'Publication')},
+     {u'Publication': ProcessDefinition(u'Publication')})
+    >>> package = xpdl.read(open(path), lazy=True)
+    >>> package.pop(u'Publication'), package.setdefault(u'Publication')
+    (ProcessDefinition(u'Publication'), None)
+
+    Each lazy package has its own index:
+
+    >>> xpdl.LazyPackage().unread is xpdl.LazyPackage().unread
+    False
+
+    Unread processes stay unread when packages are pickled:
+
+    >>> import cPickle
+    >>> package = cPickle.loads(cPickle.dumps(
+    ...     xpdl.read(open(path), lazy=True), 2))
+    >>> package.unread.keys()
+    [u'Publication']
+    >>> package
+    {u'Publication': ProcessDefinition(u'Publication')}
+    >>> package.unread
+    {}
+
+    Element text can be split over many calls to ``characters``:
+
+    >>> from StringIO import StringIO
+    >>> description = 'word ' * 10000
+    >>> package = xpdl.read(StringIO(
+    ...     '<Package xmlns="http://www.wfmc.org/2002/XPDL1.0" Id="x">'
+    ...     '<WorkflowProcesses><WorkflowProcess Id="p">'
+    ...     '<ProcessHeader><Description>%s&amp;</Description>'
+    ...     '</ProcessHeader></WorkflowProcess></WorkflowProcesses>'
+    ...     '</Package>' % description))
+    >>> package['p'].description == description + u'&'
+    True
+
+    Errors report the line they were found on:
+
+    >>> xpdl.read(StringIO(
+    ...     '<Package xmlns="http://www.wfmc.org/2002/XPDL1.0" Id="x">\\n'
+    ...     '<WorkflowProcesses><WorkflowProcess Id="p">\\n'
+    ...     '<FormalParameters><FormalParameter Id="a" Mode="SIDEWAYS"/>\\n'
+    ...     '</FormalParameters></WorkflowProcess></WorkflowProcesses>'
+    ...     '</Package>'))
+    Traceback (most recent call last):
+    ...
+    HandlerError: u'SIDEWAYS'
+    File "<string>", line 3. in FormalParameter
+
+    Transitions are added to their process at its end, but transitions
+    to unknown activities are reported at the transition:
+
+    >>> xpdl.read(StringIO(
+    ...     '<Package xmlns="http://www.wfmc.org/2002/XPDL1.0" Id="x">\\n'
+    ...     '<WorkflowProcesses><WorkflowProcess Id="p">\\n'
+    ...     '<Activities><Activity Id="a"/></Activities>\\n'
+    ...     '<Transitions><Transition Id="t" From="a" To="b"/>\\n'
+    ...     '</Transitions></WorkflowProcess></WorkflowProcesses>'
+    ...     '</Package>'))
+    Traceback (most recent call last):
+    ...
+    HandlerError: u'b'
+    File "<string>", line 4. in Transition
+
+    Handlers get SAX attributes and can set the text collected, as
+    handlers of subclasses may:
+
+    >>> class Handler(xpdl.XPDLHandler):
+    ...     start_handlers = dict(xpdl.XPDLHandler.start_handlers)
+    ...     end_handlers = dict(xpdl.XPDLHandler.end_handlers)
+    ...
+    ...     def Activity(self, attrs):
+    ...         self.labels = (sorted(attrs.getQNames()),
+    ...                        attrs.getValueByQName('Name'))
+    ...         return xpdl.XPDLHandler.Activity(self, attrs)
+    ...     start_handlers[(xpdl.xpdlns, 'Activity')] = Activity
+    ...
+    ...     def description(self, ignored):
+    ...         self.text = self.text.strip()
+    ...         xpdl.XPDLHandler.description(self, ignored)
+    ...     end_handlers[(xpdl.xpdlns, 'Description')] = description
+
+    >>> package = xpdl.Package()
+    >>> handler = Handler(package)
+    >>> xpdl._parse(xpdl._parser(handler, '<string>'), '<string>',
+    ...     '<Package xmlns="http://www.wfmc.org/2002/XPDL1.0" Id="x">'
+    ...     '<WorkflowProcesses><WorkflowProcess Id="p">'
+    ...     '<Activities><Activity Id="a" Name="A">'
+    ...     '<Description> An activity </Description>'
+    ...     '</Activity></Activities></WorkflowProcess>'
+    ...     '</WorkflowProcesses></Package>')
+    >>> handler.labels
+    ([u'Id', u'Name'], u'A')
+    >>> package['p'].activities['a'].description
+    u'An activity'
+
+    When packages are read lazily, errors in processes are raised when
+    the processes are looked up:
+
+    >>> package = xpdl.read(StringIO(
+    ...     '<?xml version="1.0" encoding="ISO-8859-1"?>\\n'
+    ...     '<x:Package xmlns:x="http://www.wfmc.org/2002/XPDL1.0"\\n'
+    ...     '           Id="x">\\n'
+    ...     '<x:WorkflowProcesses><x:WorkflowProcess Id="p">\\n'
+    ...     '<x:FormalParameters><x:FormalParameter Id="a" Mode="?"/>\\n'
+    ...     '</x:FormalParameters></x:WorkflowProcess>\\n'
+    ...     '<x:WorkflowProcess Id="q"><x:ProcessHeader>\\n'
+    ...     '<x:Description>caf\\xe9</x:Description></x:ProcessHeader>'
+    ...     '</x:WorkflowProcess><x:WorkflowProcess Id="r"/>'
+    ...     '</x:WorkflowProcesses></x:Package>'), lazy=True)
+    >>> sorted(package)
+    [u'p', u'q', u'r']
+    >>> package['q'].description
+    u'caf\\xe9'
+    >>> package['r']
+    ProcessDefinition(u'r')
+    >>> package['p']
+    Traceback (most recent call last):
+    ...
+    HandlerError: u'?'
+    File "<string>", line 5. in FormalParameter
+    >>> package.get('p')
+    Traceback (most recent call last):
+    ...
+    HandlerError: u'?'
+    File "<string>", line 5. in FormalParameter
+    """
+
+def test_xpdl_cache():
+    """
+    Packages can be cached in a directory, keyed by the file content
+    and the package version:
+
+    >>> import os, shutil, tempfile, cPickle
+    >>> from zope.wfmc import xpdl
+    >>> path = os.path.join(os.path.dirname(xpdl.__file__),
+    ...                     'publication.xpdl')
+    >>> cache = tempfile.mkdtemp()
+    >>> package = xpdl.read(open(path), cache)
+    >>> entry = os.path.join(
+    ...     cache, xpdl.cacheKey(open(path).read()) + '.pickle')
+    >>> os.listdir(cache) == [os.path.basename(entry)]
+    True
+
+    When the same content is read again, the cached package is loaded:
+
+    >>> package.marker = 'cached'
+    >>> cPickle.dump(package, open(entry, 'wb'))
+    >>> package = xpdl.read(open(path), cache)
+    >>> package.marker
+    'cached'
+    >>> pd = package[u'Publication']
+    >>> sorted(pd.activities) == sorted(xpdl.read(open(path))[u'Publication']
+    ...                                 .activities)
+    True
+    >>> [t.condition(dict(publish=True)) for t in pd.transitions
+    ...  if t.id == u'Publication_Tra10']
+    [True]
+
+    Damaged entries are replaced:
+
+    >>> open(entry, 'wb').write('garbage')
+    >>> package = xpdl.read(open(path), cache)
+    >>> getattr(package, 'marker', None)
+    >>> xpdl.read(open(path), cache).keys()
+    [u'Publication']
+
+    Other contents or versions have other keys:
+
+    >>> version = xpdl.version
+    >>> key = xpdl.cacheKey('<Package/>')
+    >>> key == xpdl.cacheKey('<Package />')
+    False
+    >>> xpdl.version = 'next'
+    >>> key == xpdl.cacheKey('<Package/>')
+    False
+    >>> xpdl.version = version
+
+    The version is looked up when it's first needed:
+
+    >>> xpdl.version = None
+    >>> key == xpdl.cacheKey('<Package/>'), xpdl.version == version
+    (True, True)
+
+    >>> shutil.rmtree(cache)
+    """
+
+def test_readFiles():
+    """
+    Many XPDL files can be read in parallel by a pool of processes:
+
+    >>> import os, shutil, tempfile
+    >>> from zope.wfmc import xpdl
+    >>> source = open(os.path.join(os.path.dirname(xpdl.__file__),
+    ...                            'publication.xpdl')).read()
+    >>> directory = tempfile.mkdtemp()
+    >>> paths = []
+    >>> for i in range(4):
+    ...     paths.append(os.path.join(directory, '%s.xpdl' % i))
+    ...     open(paths[-1], 'w').write(
+    ...         source.replace('Id="Publication"', 'Id="P%s"' % i))
+    >>> paths.append(os.path.join(directory, 'bad.xpdl'))
+    >>> open(paths[-1], 'w').write(
+    ...     source.replace('Mode="OUT"', 'Mode="SIDEWAYS"', 1))
+    >>> paths.append(os.path.join(directory, 'broken.xpdl'))
+    >>> open(paths[-1], 'w').write(source[:1000])
+    >>> paths.append(os.path.join(directory, 'missing.xpdl'))
+
+    Errors are reported by file, without stopping the others from
+    being read:
+
+    >>> packages, errors = xpdl.readFiles(paths, 2, register=True)
+    >>> sorted([(os.path.basename(path), package.keys())
+    ...         for (path, package) in packages.items()])
+    [('0.xpdl', [u'P0']), ('1.xpdl', [u'P1']), ('2.xpdl', [u'P2']),
+     ('3.xpdl', [u'P3'])]
+    >>> for path, error in sorted(errors.items()):
+    ...     print os.path.basename(path), error.__class__.__name__
+    bad.xpdl HandlerError
+    broken.xpdl ParseError
+    missing.xpdl IOError
+    >>> error = errors[paths[-3]]
+    >>> error.xml == paths[-3], error.line, error.tag
+    (True, 18, u'FormalParameter')
+
+    Malformed files are reported as SAX parsers report them:
+
+    >>> import xml.sax
+    >>> error = errors[paths[-2]]
+    >>> isinstance(error, xml.sax.SAXParseException)
+    True
+    >>> error.getSystemId() == paths[-2], error.getLineNumber()
+    (True, 22)
+    >>> xpdl.read(open(paths[-2]), lazy=True)
+    Traceback (most recent call last):
+    ...
+    ParseError: .../broken.xpdl:22:10: no element found
+
+    The process definitions were registered:
+
+    >>> import zope.component
+    >>> from zope.wfmc import interfaces
+    >>> pd = zope.component.getUtility(interfaces.IProcessDefinition, 'P2')
+    >>> pd is packages[paths[2]][u'P2']
+    True
+    >>> sorted(pd.activities) == sorted(
+    ...     xpdl.read(open(paths[0]))[u'P0'].activities)
+    True
+
+    >>> shutil.rmtree(directory)
+    """
+
+def test_table_integration():
+    """
+    Table integration components find the factories process
+    definitions need when the definitions are bound:
+
+    >>> import os
+    >>> from zope.wfmc import xpdl
+    >>> from zope.wfmc.attributeintegration import TableIntegration
+    >>> package = xpdl.read(open(os.path.join(os.path.dirname(xpdl.__file__),
+    ...                                       'publication.xpdl')))
+    >>> pd = package[u'Publication']
+    >>> zope.component.provideUtility(pd, name=pd.id)
+
+    >>> class Participant(object):
+    ...     def __init__(self, activity):
+    ...         self.activity = activity
+    >>> class WorkItem(object):
+    ...     def __init__(self, participant):
+    ...         self.participant = participant
+    ...     def start(self, *arguments):
+    ...         print self.__class__.__name__, arguments
+
+    >>> integration = TableIntegration()
+    >>> integration.Participant = Participant
+    >>> integration.authorParticipant = Participant
+    >>> integration.prepareWorkItem = WorkItem
+
+    Missing factories are reported when the definition is bound:
+
+    >>> integration.bind(pd)
+    Traceback (most recent call last):
+    ...
+    InvalidProcessDefinition: ('Missing factories', u'Publication',
+    [u'SystemParticipant', u'ed_reviewWorkItem', u'finalWorkItem',
+     u'publishWorkItem', u'rejectWorkItem', u'reviewerParticipant',
+     u'rfinalWorkItem', u'tech1Participant', u'tech2Participant',
+     u'tech_reviewWorkItem'])
+    >>> pd.integration is integration
+    False
+
+    >>> for name in (u'System', u'reviewer', u'tech1', u'tech2'):
+    ...     setattr(integration, name + 'Participant', Participant)
+    >>> for name in (u'ed_review', u'final', u'publish', u'reject',
+    ...              u'rfinal', u'tech_review'):
+    ...     setattr(integration, name + 'WorkItem',
+    ...             type(str(name), (WorkItem, ), {}))
+    >>> integration.bind(pd)
+    >>> pd.integration is integration
+    True
+    >>> sorted(integration.workitems[pd.id])
+    [u'ed_review', u'final', u'prepare', u'publish', u'reject',
+     u'rfinal', u'tech_review']
+
+    The bound factories are used when processes run.  Changing the
+    attributes doesn't change the factories until the definition is
+    bound again:
+
+    >>> class Prepare(WorkItem):
+    ...     pass
+    >>> integration.prepareWorkItem = Prepare
+    >>> proc = pd()
+    >>> proc.start('Bob')
+    WorkItem ()
+    >>> integration.bind(pd)
+    >>> proc = pd()
+    >>> proc.start('Bob')
+    Prepare ()
+
+    Definitions that aren't bound use the attributes:
+
+    >>> integration.workitems.clear()
+    >>> integration.prepareWorkItem = WorkItem
+    >>> proc = pd()
+    >>> proc.start('Bob')
+    WorkItem ()
+    """
 
 def test_suite():
     from zope.testing import doctest
@@ -208,8 +2023,31 @@ def test_suite():
         'xpdl.txt',
         setUp=setUp, tearDown=tearDown,
         optionflags=doctest.NORMALIZE_WHITESPACE))
+    suite.addTest(doctest.DocFileSuite(
+        'shard.txt',
+        setUp=testing.setUp, tearDown=testing.tearDown,
+        optionflags=doctest.NORMALIZE_WHITESPACE))
+    try:
+        import zope.wfmc.aio
+    except ImportError:
+        pass # asyncio isn't available
+    else:
+        suite.addTest(doctest.DocFileSuite(
+            'aio.txt',
+            setUp=testing.setUp, tearDown=tearDown,
+            optionflags=doctest.NORMALIZE_WHITESPACE))
+    try:
+        import concurrent.futures
+    except ImportError:
+        pass # concurrent.futures isn't available
+    else:
+        suite.addTest(doctest.DocFileSuite(
+            'executor.txt',
+            setUp=setUpPools, tearDown=tearDownPools,
+            optionflags=doctest.NORMALIZE_WHITESPACE|doctest.ELLIPSIS))
     suite.addTest(doctest.DocTestSuite(
-        setUp=testing.setUp, tearDown=testing.tearDown))
+        setUp=testing.setUp, tearDown=testing.tearDown,
+        optionflags=doctest.NORMALIZE_WHITESPACE|doctest.ELLIPSIS))
     return suite
 
 if __name__ == '__main__':
@@ -16,12 +16,28 @@
 $Id$
 """
 
+import ast
+import collections
+import cPickle
+import hashlib
+import multiprocessing
+import operator
+import os
+import re
+import StringIO
 import sys
+import tempfile
+import threading
+import UserDict
+import xml.parsers.expat
 import xml.sax
-import xml.sax.xmlreader
+import xml.sax.saxutils
 import xml.sax.handler
+import xml.sax.xmlreader
 
+import zope.component
 import zope.wfmc.process
+from zope.wfmc import interfaces
 
 xpdlns = "http://www.wfmc.org/2002/XPDL1.0"
 
@@ -42,13 +58,51 @@ class HandlerError(Exception):
         return ('%s\nFile "%s", line %s. in %s'
                 % (self.orig, self.xml, self.line, self.tag))
 
+    def __reduce__(self):
+        # Locators can't be pickled, so we pickle the location.
+        return (self.__class__,
+                (self.orig, self.tag, Location(self.xml, self.line)))
+
+class ParseError(xml.sax.SAXParseException):
+    """Malformed XML, reported as SAX parsers report it
+    """
+
+    def __reduce__(self):
+        # Locators can't be pickled, so we pickle the location.
+        return (self.__class__,
+                (self._msg, self._exception,
+                 Location(self._systemId, self._linenum, self._colnum)))
+
+class Location:
+    """Locator for a known location
+    """
+
+    def __init__(self, system_id, line, column=None):
+        self.system_id = system_id
+        self.line = line
+        self.column = column
+
+    def getSystemId(self):
+        return self.system_id
+
+    def getPublicId(self):
+        return None
+
+    def getLineNumber(self):
+        return self.line
+
+    def getColumnNumber(self):
+        return self.column
+
 
 class Package(dict):
+    """Process definitions read from an XPDL file
+    """
 
     def __init__(self):
         self.applications = {}
         self.participants = {}
-    
+
     def defineApplications(self, **applications):
         for id, application in applications.items():
             application.id = id
@@ -59,12 +113,127 @@ class Package(dict):
             participant.id = id
             self.participants[id] = participant
 
+class LazyPackage(UserDict.DictMixin):
+    """Process definitions read lazily from an XPDL file
+
+    The processes are only indexed at first.  Each process is read from
+    the file's content when it's first looked up, and is stored as None
+    until then.  This isn't a dictionary, so that processes can't be
+    looked up without being read.
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.applications = {}
+        self.participants = {}
+        # Process id -> (start offset, end offset, line) for unread
+        # processes
+        self.unread = {}
+
+    defineApplications = Package.defineApplications.im_func
+    defineParticipants = Package.defineParticipants.im_func
+
+    def __getitem__(self, id):
+        result = self.data[id]
+        if result is None and id in self.unread:
+            result = self._read(id)
+        return result
+
+    def __setitem__(self, id, value):
+        self.data[id] = value
+
+    def __delitem__(self, id):
+        del self.data[id]
+        self.unread.pop(id, None)
+
+    def __contains__(self, id):
+        return id in self.data
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def keys(self):
+        return self.data.keys()
+
+    def __len__(self):
+        return len(self.data)
+
+    def copy(self):
+        return dict(self.iteritems())
+
+    def _read(self, id):
+        _read_lock.acquire()
+        try:
+            if id not in self.unread:
+                return self.data[id]
+            start, end, line = self.unread[id]
+
+            # The process is parsed in an element that declares the
+            # namespaces used, on the line it was found on, so that
+            # errors give the right line numbers:
+            handler = XPDLHandler(self)
+            handler.stack.append(self)
+            parser = _parser(handler, self.system_id)
+            try:
+                _parse(parser, self.system_id, ''.join((
+                    self.prologue, '\n' * (line - 1),
+                    self.source[start:end], '</fragment>',
+                    )))
+            except:
+                self.data[id] = None
+                raise
+
+            del self.unread[id]
+            if not self.unread:
+                del self.source
+            return self.data[id]
+        finally:
+            _read_lock.release()
+
+_read_lock = threading.Lock()
+
+class Definitions(UserDict.DictMixin):
+    """Definitions of a process, including those shared by its package
+    """
+
+    def __init__(self, shared):
+        self.shared = shared
+        self.data = {}
+
+    def __getitem__(self, id):
+        try:
+            return self.data[id]
+        except KeyError:
+            return self.shared[id]
+
+    def __setitem__(self, id, value):
+        self.data[id] = value
+
+    def __delitem__(self, id):
+        del self.data[id]
+
+    def __contains__(self, id):
+        return id in self.data or id in self.shared
+
+    def __iter__(self):
+        for id in self.data:
+            yield id
+        for id in self.shared:
+            if id not in self.data:
+                yield id
+
+    def keys(self):
+        return list(self.__iter__())
+
+    def __len__(self):
+        return len(self.data) + len([id for id in self.shared
+                                     if id not in self.data])
+
 
 class XPDLHandler(xml.sax.handler.ContentHandler):
 
     start_handlers = {}
     end_handlers = {}
-    text = u''
     
     ProcessDefinitionFactory = zope.wfmc.process.ProcessDefinition
     ParticipantFactory = zope.wfmc.process.Participant
@@ -75,6 +244,20 @@ class XPDLHandler(xml.sax.handler.ContentHandler):
     def __init__(self, package):
         self.package = package
         self.stack = []
+        self.chunks = []
+
+    def _getText(self):
+        # Text is collected in chunks, which are joined when the text
+        # is used, to avoid repeated concatenation.
+        chunks = self.chunks
+        if len(chunks) != 1:
+            chunks[:] = [u''.join(chunks)]
+        return chunks[0]
+
+    def _setText(self, text):
+        self.chunks = [text]
+
+    text = property(_getText, _setText)
 
     def startElementNS(self, name, qname, attrs):
         handler = self.start_handlers.get(name)
@@ -92,7 +275,7 @@ class XPDLHandler(xml.sax.handler.ContentHandler):
             result = self.stack[-1]
             
         self.stack.append(result)
-        self.text = u''
+        self.chunks = []
 
     def endElementNS(self, name, qname):
         last = self.stack.pop()
@@ -104,10 +287,10 @@ class XPDLHandler(xml.sax.handler.ContentHandler):
                 raise HandlerError(sys.exc_info()[1], name[1], self.locator
                     ), None, sys.exc_info()[2]
 
-        self.text = u''
+        self.chunks = []
 
     def characters(self, text):
-        self.text += text
+        self.chunks.append(text)
 
     def setDocumentLocator(self, locator):
         self.locator = locator
@@ -129,14 +312,24 @@ class XPDLHandler(xml.sax.handler.ContentHandler):
         process = self.ProcessDefinitionFactory(id)
         process.__name__ = attrs.get((None, 'Name'))
 
-        # Copy package data:
-        process.defineApplications(**self.package.applications)
-        process.defineParticipants(**self.package.participants)
+        # Share package data:
+        process.applications = Definitions(self.package.applications)
+        process.participants = Definitions(self.package.participants)
 
         self.package[id] = process
+
+        # Transitions are collected and added to the process in bulk
+        # when we're done with it:
+        self.transitions = []
+        self.outgoing_refs = {}
         return process
     start_handlers[(xpdlns, 'WorkflowProcess')] = WorkflowProcess
 
+    def workflowprocess(self, process):
+        process.build(transitions=self.transitions,
+                      outgoing_refs=self.outgoing_refs)
+    end_handlers[(xpdlns, 'WorkflowProcess')] = workflowprocess
+
     paramter_types = {
         'IN': zope.wfmc.process.InputParameter,
         'OUT': zope.wfmc.process.OutputParameter,
@@ -223,7 +416,7 @@ class XPDLHandler(xml.sax.handler.ContentHandler):
 
     def TransitionRef(self, attrs):
         Id = attrs.get((None, 'Id'))
-        self.stack[-1].addOutgoing(Id)
+        self.outgoing_refs.setdefault(self.stack[-1].id, []).append(Id)
     start_handlers[(xpdlns, 'TransitionRef')] = TransitionRef
         
 
@@ -242,7 +435,13 @@ class XPDLHandler(xml.sax.handler.ContentHandler):
     start_handlers[(xpdlns, 'Transition')] = Transition
     
     def transition(self, transition):
-        self.stack[-1].defineTransitions(transition)
+        # The transitions are only added at the end of the process, so
+        # check that their activities exist here, where the error can
+        # be reported at the transition.
+        activities = self.stack[-1].activities
+        activities[transition.from_]
+        activities[transition.to]
+        self.transitions.append(transition)
     end_handlers[(xpdlns, 'Transition')] = transition
     
     def condition(self, ignored):
@@ -261,36 +460,535 @@ class Tool:
 
     parameters = ()
   
+######################################################################
+# Condition compiler
+#
+# Conditions are compiled to closures that take workflow data and
+# look variables up as items of the data.  Only a subset of Python
+# expressions is supported.
+
+_constants = {'None': None, 'True': True, 'False': False}
+
+def _name(node):
+    name = node.id
+    if name in _constants:
+        value = _constants[name]
+        return lambda data: value
+
+    private = name.startswith('_')
+
+    def lookup(data):
+        try:
+            return data[name]
+        except KeyError:
+            pass
+        except (TypeError, AttributeError):
+            # Data that aren't mappings, like objects with slots,
+            # provide variables as attributes.
+            if not private:
+                try:
+                    return getattr(data, name)
+                except AttributeError:
+                    pass
+        raise NameError("name %r is not defined" % name)
+    return lookup
+
+def _attribute(node):
+    name = node.attr
+    if name.startswith('_'):
+        raise SyntaxError("Private attribute %r isn't allowed in conditions"
+                          % name)
+    value = _compile(node.value)
+    return lambda data: getattr(value(data), name)
+
+def _constant(value):
+    return lambda data: value
+
+def _num(node):
+    return _constant(node.n)
+
+def _str(node):
+    return _constant(node.s)
+
+def _sequence(node):
+    items = [_compile(item) for item in node.elts]
+    if isinstance(node, ast.List):
+        return lambda data: [item(data) for item in items]
+    return lambda data: tuple([item(data) for item in items])
+
+def _boolop(node):
+    values = [_compile(value) for value in node.values]
+    if isinstance(node.op, ast.And):
+        def and_(data):
+            for value in values:
+                result = value(data)
+                if not result:
+                    break
+            return result
+        return and_
+    else:
+        def or_(data):
+            for value in values:
+                result = value(data)
+                if result:
+                    break
+            return result
+        return or_
+
+_unaryops = {
+    ast.Not: operator.not_,
+    ast.USub: operator.neg,
+    ast.UAdd: operator.pos,
+    }
+
+def _unaryop(node):
+    op = _operator(_unaryops, node.op)
+    operand = _compile(node.operand)
+    return lambda data: op(operand(data))
+
+_binops = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.div,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    }
+
+def _binop(node):
+    op = _operator(_binops, node.op)
+    left = _compile(node.left)
+    right = _compile(node.right)
+    return lambda data: op(left(data), right(data))
+
+_comparisons = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+    ast.Is: operator.is_,
+    ast.IsNot: operator.is_not,
+    ast.In: lambda a, b: a in b,
+    ast.NotIn: lambda a, b: a not in b,
+    }
+
+def _compare(node):
+    left = _compile(node.left)
+    ops = [_operator(_comparisons, op) for op in node.ops]
+    comparators = [_compile(comparator) for comparator in node.comparators]
+
+    if len(ops) == 1:
+        op, right = ops[0], comparators[0]
+        return lambda data: op(left(data), right(data))
+
+    steps = zip(ops, comparators)
+    def compare(data):
+        a = left(data)
+        for op, comparator in steps:
+            b = comparator(data)
+            if not op(a, b):
+                return False
+            a = b
+        return True
+    return compare
+
+def _operator(operators, op):
+    try:
+        return operators[op.__class__]
+    except KeyError:
+        raise SyntaxError("%s isn't allowed in conditions"
+                          % op.__class__.__name__)
+
+_compilers = {
+    ast.Name: _name,
+    ast.Attribute: _attribute,
+    ast.Num: _num,
+    ast.Str: _str,
+    ast.Tuple: _sequence,
+    ast.List: _sequence,
+    ast.BoolOp: _boolop,
+    ast.UnaryOp: _unaryop,
+    ast.BinOp: _binop,
+    ast.Compare: _compare,
+    }
+
+def _compile(node):
+    try:
+        compiler = _compilers[node.__class__]
+    except KeyError:
+        raise SyntaxError("%s isn't allowed in conditions"
+                          % node.__class__.__name__)
+    return compiler(node)
+
+def compileExpression(source):
+    """Compile a condition expression to a function of workflow data
+
+    The expression may only contain names, which are looked up as
+    items of the data, non-private attributes, number and string
+    literals, tuples, lists, comparisons, and boolean and arithmetic
+    operators.  Anything else raises a SyntaxError.
+    """
+    return _compile(ast.parse(source.strip(), '<string>', 'eval').body)
+
+def equalityGuard(source):
+    """Return the variable and constant an equality condition compares
+
+    None is returned if the condition isn't a comparison of a
+    variable with a number or string.
+    """
+    node = ast.parse(source.strip(), '<string>', 'eval').body
+    if not (isinstance(node, ast.Compare) and len(node.ops) == 1
+            and isinstance(node.ops[0], ast.Eq)):
+        return None
+
+    name, constant = node.left, node.comparators[0]
+    if isinstance(constant, ast.Name):
+        name, constant = constant, name
+    if not isinstance(name, ast.Name) or name.id in _constants:
+        return None
+    if isinstance(constant, ast.Num):
+        return name.id, constant.n
+    if isinstance(constant, ast.Str):
+        return name.id, constant.s
+    return None
+
+# Compiled conditions, shared by all conditions with the same source,
+# with the most recently used last.
+conditionCacheSize = 1000
+_compiled = collections.OrderedDict()
+_compiled_lock = threading.Lock()
+
+def compileCondition(source):
+    """Compile condition source, reusing recently compiled conditions
+    """
+    _compiled_lock.acquire()
+    try:
+        compiled = _compiled.pop(source, None)
+        if compiled is not None:
+            _compiled[source] = compiled
+            return compiled
+    finally:
+        _compiled_lock.release()
+
+    compiled = compileExpression(source)
+
+    _compiled_lock.acquire()
+    try:
+        _compiled[source] = compiled
+        while len(_compiled) > conditionCacheSize:
+            _compiled.popitem(False)
+    finally:
+        _compiled_lock.release()
+
+    return compiled
+
 class TextCondition:
 
     def __init__(self, source):
         self.source = source
 
         # make sure that we can compile the source
-        compile(source, '<string>', 'eval')
+        self._v_compiled = compileCondition(source)
 
     def __getstate__(self):
         return {'source': self.source}
 
+    def guard(self):
+        # Variable and constant compared by equality conditions, used
+        # to build decision tables for xor splits.
+        return equalityGuard(self.source)
+    guard = property(guard)
+
     def __call__(self, data):
-        # We *depend* on being able to use the data's dict.
-        # TODO This needs to be part of the contract.
+        # Variables are looked up as items of the data or, if the data
+        # aren't a mapping, as attributes.
         try:
             compiled = self._v_compiled
         except AttributeError:
-            self._v_compiled = compile(self.source, '<string>', 'eval')
-            compiled = self._v_compiled
+            compiled = self._v_compiled = compileCondition(self.source)
 
-        return eval(compiled, {'__builtins__': None}, data.__dict__)
+        return compiled(data)
     
 
-def read(file):
-    src = xml.sax.xmlreader.InputSource(getattr(file, 'name', '<string>'))
-    src.setByteStream(file)
-    parser = xml.sax.make_parser()
-    package = Package()
-    parser.setContentHandler(XPDLHandler(package))
-    parser.setFeature(xml.sax.handler.feature_namespaces, True)
-    parser.parse(src)
+class ExpatLocator:
+    """Locator for handlers driven directly by expat
+    """
+
+    def __init__(self, parser, system_id):
+        self.parser = parser
+        self.system_id = system_id
+
+    def getSystemId(self):
+        return self.system_id
+
+    def getLineNumber(self):
+        return self.parser.CurrentLineNumber
+
+def _parser(handler, system_id):
+    # Create an expat parser that calls the handler's SAX methods
+    parser = xml.parsers.expat.ParserCreate(namespace_separator=' ')
+    parser.buffer_text = True
+    handler.setDocumentLocator(ExpatLocator(parser, system_id))
+
+    # Expat gives us names as 'namespace name' or just 'name'
+    names = {}
+    def split(name):
+        try:
+            return names[name]
+        except KeyError:
+            parts = name.split(' ')
+            if len(parts) == 1:
+                parts.insert(0, None)
+            result = names[name] = tuple(parts)
+            return result
+
+    startElementNS = handler.startElementNS
+    endElementNS = handler.endElementNS
+    Attributes = xml.sax.xmlreader.AttributesNSImpl
+
+    def start(name, attrs):
+        # As with the SAX expat reader, without namespace prefixes, the
+        # qualified names of attributes are their local names.
+        values = {}
+        qnames = {}
+        for key, value in attrs.iteritems():
+            key = split(key)
+            values[key] = value
+            qnames[key] = key[1]
+        startElementNS(split(name), None, Attributes(values, qnames))
+
+    def end(name):
+        endElementNS(split(name), None)
+
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    parser.CharacterDataHandler = handler.characters
+    return parser
+
+def _parse(parser, system_id, data):
+    # Parse a string or a file, raising a SAXParseException, as SAX
+    # parsers do, if the XML is malformed.
+    try:
+        if isinstance(data, str):
+            parser.Parse(data, True)
+        else:
+            parser.ParseFile(data)
+    except xml.parsers.expat.ExpatError, v:
+        raise ParseError(xml.parsers.expat.ErrorString(v.code), v,
+                         Location(system_id, v.lineno, v.offset))
+
+_start_tag = re.compile(r"""<[^>"']*(?:(?:"[^"]*"|'[^']*')[^>"']*)*>""")
+
+def parse(file, lazy=False):
+    """Parse a package from an XPDL file
+
+    The file is parsed with expat directly, rather than through SAX,
+    calling the handler's namespace-aware SAX methods.
+
+    If lazy is true, workflow processes are skipped and only indexed,
+    and a ``LazyPackage`` is returned.  The processes are read when
+    they're looked up in the package.
+    """
+    if lazy:
+        package = LazyPackage()
+    else:
+        package = Package()
+    handler = XPDLHandler(package)
+    system_id = getattr(file, 'name', '<string>')
+    parser = _parser(handler, system_id)
+    if not lazy:
+        _parse(parser, system_id, file)
+        return package
+
+    data = file.read()
+    start = parser.StartElementHandler
+    end = parser.EndElementHandler
+    characters = parser.CharacterDataHandler
+    process = xpdlns + ' WorkflowProcess'
+    namespaces = {}
+    encoding = []
+    unread = {}
+    skipping = [] # Id, offset, line and depth of the skipped process
+
+    def skipStart(name, attrs):
+        if skipping:
+            skipping[3] += 1
+        elif name == process:
+            skipping[:] = [attrs['Id'], parser.CurrentByteIndex,
+                           parser.CurrentLineNumber, 1]
+            parser.CharacterDataHandler = None
+        else:
+            start(name, attrs)
+
+    def skipEnd(name):
+        if not skipping:
+            return end(name)
+        skipping[3] -= 1
+        if skipping[3]:
+            return
+        id, offset, line, depth = skipping
+        del skipping[:]
+        parser.CharacterDataHandler = characters
+
+        # We're either at the end tag or, for empty elements, after
+        # the element:
+        tag = _start_tag.match(data, offset)
+        if tag.group().endswith('/>'):
+            index = tag.end()
+        else:
+            index = data.index('>', parser.CurrentByteIndex) + 1
+        unread[id] = offset, index, line
+        package.data[id] = None
+
+    def namespace(prefix, uri):
+        if not skipping:
+            namespaces[prefix] = uri
+
+    def declaration(version, encoding_, standalone):
+        encoding.append(encoding_)
+
+    parser.StartElementHandler = skipStart
+    parser.EndElementHandler = skipEnd
+    parser.StartNamespaceDeclHandler = namespace
+    parser.XmlDeclHandler = declaration
+    _parse(parser, system_id, data)
+
+    if unread:
+        prologue = []
+        if encoding and encoding[0]:
+            prologue.append('<?xml version="1.0" encoding=%s?>'
+                            % xml.sax.saxutils.quoteattr(encoding[0]))
+        prologue.append('<fragment')
+        for prefix, uri in sorted(namespaces.items()):
+            prologue.append(' %s=%s' % (
+                prefix and 'xmlns:' + prefix or 'xmlns',
+                xml.sax.saxutils.quoteattr(uri)))
+        prologue.append('>')
+        package.prologue = str(''.join(prologue))
+        package.source = data
+        package.system_id = system_id
+        package.unread = unread
+
     return package
-    
+
+# The version of this package.  It's looked up when a cache key is
+# first computed, because importing pkg_resources is slow.
+version = None
+
+def cacheKey(data):
+    """Return the cache key for the contents of an XPDL file
+
+    The key depends on the version of this package, so that cached
+    packages are discarded when the package is upgraded.
+    """
+    global version
+    if version is None:
+        import pkg_resources
+        try:
+            version = pkg_resources.get_distribution('zope.wfmc').version
+        except pkg_resources.DistributionNotFound:
+            version = ''
+    return hashlib.sha1('%s %s %s\n%s' % (
+        version, sys.version_info[:2], cPickle.HIGHEST_PROTOCOL, data,
+        )).hexdigest()
+
+def read(file, cache=None, lazy=False):
+    """Read a package from an XPDL file
+
+    If a cache directory is given, packages are pickled there, keyed by
+    the content of the file, and are loaded from the cache rather than
+    parsed when the same content is read again.
+
+    If lazy is true, workflow processes are read when they're first
+    looked up in the package.
+    """
+    if cache is None:
+        return parse(file, lazy)
+
+    data = file.read()
+    path = os.path.join(cache, cacheKey(data) + (lazy and '-lazy' or '')
+                        + '.pickle')
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        pass
+    else:
+        try:
+            try:
+                return cPickle.load(f)
+            except Exception:
+                pass # A damaged cache entry, parse the file again
+        finally:
+            f.close()
+
+    stream = StringIO.StringIO(data)
+    stream.name = getattr(file, 'name', '<string>')
+    package = parse(stream, lazy)
+
+    # Write the pickle to a temporary file and rename it, so that
+    # readers never see a partial entry:
+    fd, temp = tempfile.mkstemp('.tmp', '', cache)
+    try:
+        f = os.fdopen(fd, 'wb')
+        try:
+            cPickle.dump(package, f, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        os.rename(temp, path)
+    except:
+        os.remove(temp)
+        raise
+
+    return package
+
+def _readFile(args):
+    # Read a file in a worker process
+    path, cache = args
+    try:
+        file = open(path, 'rb')
+        try:
+            return path, read(file, cache), None
+        finally:
+            file.close()
+    except (HandlerError, xml.sax.SAXParseException, EnvironmentError), v:
+        return path, None, v
+
+def readFiles(paths, processes=None, cache=None, register=False):
+    """Read packages from many XPDL files in a pool of processes
+
+    Files are read by the given number of worker processes, which
+    defaults to the number of CPUs, and may use a cache directory.  A
+    dictionary of packages and a dictionary of errors, both keyed by
+    path, are returned.  Files with errors, including files that can't
+    be read, are left out of the packages.
+
+    If register is true, the process definitions read are registered
+    as ``IProcessDefinition`` utilities, named by their ids.
+    """
+    packages = {}
+    errors = {}
+    pool = multiprocessing.Pool(processes)
+    try:
+        for path, package, error in pool.imap_unordered(
+            _readFile, [(path, cache) for path in paths]):
+            if error is None:
+                packages[path] = package
+            else:
+                errors[path] = error
+    except:
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
+
+    if register:
+        for path in paths:
+            if path in packages:
+                for definition in packages[path].values():
+                    zope.component.provideUtility(
+                        definition, interfaces.IProcessDefinition,
+                        definition.id)
+
+    return packages, errors